@@ -0,0 +1,26 @@
+"""Simulation Backend
+
+This module selects the library that controls SUMO, according to the `BACKEND` parameter of the `config.ini` file.
+The `traci` backend talks to a separate SUMO process through a socket, while `libsumo` runs the simulation inside the Python process, without the socket protocol overhead (headless only, one simulation per process).
+
+"""
+
+import importlib
+
+BACKENDS = ['traci', 'libsumo']
+
+class Backend:
+    # forwards the TraCI API calls (e.g. `traci.vehicle.getSpeed`) to the selected library
+    def __init__(self, name='traci'):
+        self.use(name)
+
+    def use(self, name):
+        if name not in BACKENDS:
+            raise Exception(f"Unknown simulation backend '{name}', choose from {BACKENDS}")
+        self.name = name
+        self.module = importlib.import_module(name)
+
+    def __getattr__(self, attr):
+        return getattr(self.module, attr)
+
+traci = Backend()
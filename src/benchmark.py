@@ -0,0 +1,429 @@
+"""Performance Benchmarks
+
+This script compares alternative implementations of the hot paths of the framework, running them side by side on the network selected in the `config.ini` file.
+The benchmarks to run can be given as arguments (e.g. `python -m src.benchmark counting`), otherwise all of them are executed.
+
+"""
+
+import re
+import os, sys, time
+import json
+import pickle
+import tempfile
+import sumolib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from .utils import load_config, load_sheets, RESULTS_FORMATS, check_results_format, get_results_file, write_results, read_results, get_free_variables, get_entry_exit_nodes, get_eq_variables, load_artifact, load_free_variables, load_entry_exit_nodes
+from .digital_twin import get_node_sensors, initialize_variables, get_sensors_edges, build_topology_index, get_headless_binary, prepare_sumo, get_isolated_sumo_cmd, generate_calibrators, replay_calibrators, generate_routes, generate_flows, reset_flow_speed_min, get_sensors_data, get_week_days, get_minute_variables_values
+from .solver import get_equation_systems, solve_network
+from .prepare import prepare_data, export_sensor_data
+from .backend import BACKENDS, traci
+import src.logic_functions as fn
+
+def load_network(config):
+    network_name, network_file = config.get('benchmark', 'NETWORK', fallback=config.get('nodes', 'NODE_ARTICLE', fallback='Article,./nodes/no_artigo.net.xml')).split(',')
+    network = sumolib.net.readNet(network_file)
+
+    entries_exits_file = config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md')
+    artifacts_dir = config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts')
+    _, node_sensors = get_node_sensors(config, network_name)
+
+    entry_nodes, exit_nodes, _, _, sensors, _ = initialize_variables(network_name, network_file, node_sensors, entries_exits_file, artifacts_dir)
+    sensors_edges = get_sensors_edges(network, sensors)
+
+    return network_name, network_file, network, entry_nodes, exit_nodes, sensors_edges
+
+def get_headless_cmd(config, network_name):
+    sumo_cmd = prepare_sumo(config, network_name)
+    sumo_cmd[0] = get_headless_binary(sumo_cmd[0]) # the benchmarks are not meant to be watched
+    return sumo_cmd + ['--no-step-log', 'true']
+
+def run_counting(sumo_cmd, network, entry_nodes, exit_nodes, sensors_edges, counting, seconds, step_length, lifecycle=False):
+    steps_per_second = int(1 / step_length)
+    total_steps = seconds * steps_per_second
+    oldVehIDs = {node: set() for node in entry_nodes + exit_nodes}
+    active_vehicles = set()
+    flow_speed_min = reset_flow_speed_min(entry_nodes, exit_nodes)
+    minute_flows = []
+    hour_tracking = [] # [(vehIDs held by the counting, vehicles in the network)] at the end of each hour
+
+    entry_counting_edges, exit_counting_edges, _ = build_topology_index(network, entry_nodes, exit_nodes, sensors_edges)
+    counting_edges = list(entry_counting_edges.items()) + list(exit_counting_edges.items())
+
+    traci.start(sumo_cmd)
+    if counting == 'subscription':
+        fn.subscribeCountingEdges([edges for _, edges in counting_edges])
+    if lifecycle:
+        fn.subscribeLifecycle()
+
+    steps_per_iteration = steps_per_second if counting == 'subscription' else 1 # the subscription results are only delivered when counting
+    start_time = time.perf_counter()
+    counting_time = 0
+    for step in range(steps_per_iteration, total_steps + 1, steps_per_iteration):
+        traci.simulationStep(step * step_length) if steps_per_iteration > 1 else traci.simulationStep()
+        if lifecycle:
+            counting_start = time.perf_counter()
+            fn.trackVehicles(active_vehicles, oldVehIDs, *fn.getLifecycleEvents())
+            counting_time += time.perf_counter() - counting_start
+
+        if step % steps_per_second == 0:
+            counting_start = time.perf_counter()
+            counting_results = fn.getCountingResults() if counting == 'subscription' else ()
+            for node, (start_edge, next_edge) in counting_edges:
+                flow, speed, oldVehIDs[node], _ = fn.edgeVehParameters(start_edge, next_edge, oldVehIDs[node], *counting_results)
+                flow_speed_min[node] = (flow_speed_min[node][0], flow_speed_min[node][1] + flow, flow_speed_min[node][2] + speed)
+            counting_time += time.perf_counter() - counting_start
+
+        if step % (60 * steps_per_second) == 0:
+            minute_flows.append(flow_speed_min)
+            flow_speed_min = reset_flow_speed_min(entry_nodes, exit_nodes)
+
+        if step % (3600 * steps_per_second) == 0:
+            hour_tracking.append((sum(len(vehIDs) for vehIDs in oldVehIDs.values()), traci.vehicle.getIDCount()))
+
+    elapsed = time.perf_counter() - start_time
+    traci.close()
+
+    return total_steps / elapsed, counting_time, minute_flows, hour_tracking
+
+def benchmark_counting(config):
+    network_name, _, network, entry_nodes, exit_nodes, sensors_edges = load_network(config)
+    sumo_cmd = get_headless_cmd(config, network_name)
+    seconds = int(config.get('benchmark', 'SECONDS', fallback='1800'))
+    step_length = float(config.get('params', 'STEP_LENGTH', fallback='0.25'))
+
+    repeats = int(config.get('benchmark', 'REPEATS', fallback='3'))
+
+    print(f"\n::: Counting engines on {network_name} ({seconds} simulated seconds, best of {repeats}) :::\n")
+    results = {}
+    for counting in ['polling', 'subscription']:
+        runs = [run_counting(sumo_cmd, network, entry_nodes, exit_nodes, sensors_edges, counting, seconds, step_length) for _ in range(repeats)]
+        results[counting] = max(runs, key=lambda run: run[0])
+        print(f"{counting}: {results[counting][0]:.1f} steps/s, {results[counting][1]:.2f}s spent counting")
+
+    print(f"Speedup: {results['subscription'][0] / results['polling'][0]:.2f}x (counting only: {results['polling'][1] / results['subscription'][1]:.2f}x)")
+    print(f"Identical per-minute flows: {results['subscription'][2] == results['polling'][2]}")
+
+def benchmark_lifecycle(config):
+    network_name, _, network, entry_nodes, exit_nodes, sensors_edges = load_network(config)
+    sumo_cmd = get_headless_cmd(config, network_name)
+    hours = int(config.get('benchmark', 'HOURS', fallback='24'))
+    step_length = float(config.get('params', 'STEP_LENGTH', fallback='0.25'))
+
+    print(f"\n::: Vehicle lifecycle tracking on {network_name} ({hours} simulated hours) :::\n")
+    results = {}
+    for lifecycle in [False, True]:
+        name = 'departed/arrived events' if lifecycle else 'counting edges only'
+        results[lifecycle] = run_counting(sumo_cmd, network, entry_nodes, exit_nodes, sensors_edges, 'subscription', hours * 3600, step_length, lifecycle)
+        held = [tracked for tracked, _ in results[lifecycle][3]]
+        print(f"{name}: {results[lifecycle][1] / (hours * 3600) * 1e6:.1f} us per simulated second, {max(held)} vehIDs held at most, {held[-1]} after {hours}h ({results[lifecycle][3][-1][1]} vehicles in the network)")
+        print(f"  vehIDs held per hour: {held}")
+
+    print(f"Identical per-minute flows: {results[True][2] == results[False][2]}")
+
+def run_sampler(sampler, minutes, inputs, num_simplex_runs, num_samples, max_attempts=50, seed=0):
+    # `sampler` is 'simplex', 'vectorized' or 'projection_<norm>'
+    free_vars, A_ub, b_ub, Xparticular_expr, Xnull, _ = inputs['free_variables']
+    free_variables_order = sorted(free_vars, key=lambda x: int(x[1:]))
+    np.random.seed(seed)
+    fn.lp_stats.update(dict.fromkeys(fn.lp_stats, 0))
+    distances, relative_errors, failed_minutes, solutions = [], [], 0, []
+    last_free_solution = None
+
+    start_time = time.perf_counter()
+    for minute in range(minutes):
+        variables_values = get_minute_variables_values(inputs['sensors_edges'], inputs['sensors_data'], inputs['variables'], minute)
+        free_variables_target = {var: inputs['intensities'][var][(minute // 60) % 24] for var in free_vars}
+
+        for _ in range(1 if sampler.startswith('projection') else max_attempts): # the projection gives the same solution on every attempt
+            if sampler == 'vectorized':
+                closest, targets, Xparticular = fn.vectorizedFreeVarRange(variables_values, free_variables_order, free_variables_target, A_ub, b_ub, Xparticular_expr, Xnull, num_samples, warm_start=last_free_solution)
+            elif sampler.startswith('projection'):
+                closest, targets, Xparticular = fn.projectedFreeVarRange(variables_values, free_variables_order, free_variables_target, A_ub, b_ub, Xparticular_expr, Xnull, sampler.split('_')[1])
+            else:
+                closest, targets, Xparticular = fn.restrictedFreeVarRange(variables_values, free_variables_order, free_variables_target, A_ub, b_ub, Xparticular_expr, Xnull, num_simplex_runs)
+            if np.all(fn.calc_x_complete(free_variables_order, Xparticular, Xnull, closest) >= 0):
+                last_free_solution = closest
+                break
+        else:
+            failed_minutes += 1
+            continue
+
+        solutions.append(closest)
+        target_vec = np.array([targets[var] for var in free_variables_order])
+        distances.append(np.linalg.norm(closest - target_vec))
+        if np.linalg.norm(target_vec) > 0:
+            relative_errors.append(distances[-1] / np.linalg.norm(target_vec))
+
+    elapsed = time.perf_counter() - start_time
+
+    solves = {kind: fn.lp_stats[f'{prefix}success'] + fn.lp_stats[f'{prefix}failure'] for kind, prefix in [('simplex', ''), ('MILP', 'milp_'), ('QP', 'qp_')]} # runs of each kind of solver
+
+    return elapsed, solves, np.mean(distances), np.mean(relative_errors), failed_minutes, solutions
+
+def benchmark_sampler(config):
+    network_name, network_file, _, _, _, sensors_edges = load_network(config)
+    node_filename = network_file.split('.')[-3].split('/')[-1]
+    nodes_dir = config.get('dir', 'NODES', fallback='./nodes')
+    data_file = config.get('sensors', 'DATA_ARTICLE', fallback='./data/article_data.xlsx') if network_name == 'Article' else config.get('sensors', 'DATA', fallback='./data/sensor_data')
+    minutes = int(config.get('benchmark', 'MINUTES', fallback='60'))
+    num_simplex_runs = int(config.get('params', 'NUM_SIMPLEX_RUNS', fallback='300'))
+    num_samples = int(config.get('params', 'NUM_SAMPLES', fallback='3000'))
+
+    _, node_sensors = get_node_sensors(config, network_name)
+    with open(f"{nodes_dir}/variables_{node_filename}.pkl", 'rb') as f:
+        variables = pickle.load(f)
+    with open(config.get('nodes', 'INTENSITIES', fallback='./nodes/intensities.json'), 'r') as int_file:
+        intensities = json.load(int_file)
+    timestamp_hours, sensors_data = get_sensors_data(network_name, node_sensors, data_file, config.get('sensors', 'CACHE', fallback=''))
+    (free_vars, A_ub, b_ub, Xparticular_expr, Xnull, eq_vars), compiled_expr = load_free_variables(config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts'), config.get('nodes', 'FREE_VARIABLES', fallback='./nodes/free_variables.md'), network_name)
+    if config.get('params', 'EXPRESSIONS', fallback='compiled') == 'compiled':
+        b_ub, Xparticular_expr = compiled_expr or (fn.compile_list_expr(b_ub), fn.compile_x_particular(Xparticular_expr))
+    inputs = {
+        'free_variables': (free_vars, A_ub, b_ub, Xparticular_expr, Xnull, eq_vars),
+        'sensors_edges': sensors_edges,
+        'sensors_data': sensors_data,
+        'variables': variables,
+        'intensities': intensities[network_name][get_week_days(timestamp_hours)[0]],
+    }
+
+    print(f"\n::: Free-variable samplers on {network_name} ({minutes} simulated minutes) :::\n")
+    for sampler in ['simplex', 'vectorized', 'projection_l1', 'projection_l2']:
+        elapsed, solves, distance, relative_error, failed_minutes, solutions = run_sampler(sampler, minutes, inputs, num_simplex_runs, num_samples)
+        other_solutions = run_sampler(sampler, minutes, inputs, num_simplex_runs, num_samples, seed=1)[5]
+        reproducible = len(other_solutions) == len(solutions) and all(np.array_equal(a, b) for a, b in zip(solutions, other_solutions)) # the same solutions with another seed
+        print(f"{sampler}: {', '.join(f'{runs / minutes:.1f} {kind} runs' for kind, runs in solves.items() if runs or kind == 'simplex')}/minute, {1000 * elapsed / minutes:.1f} ms/minute, mean distance to the target {distance:.2f} (relative {relative_error:.4f}), {failed_minutes} minutes without a feasible solution, {'same' if reproducible else 'different'} solutions with another seed")
+
+def load_network_inputs(source, network_name, free_variables_file, entries_exits_file, equations_file, artifacts_dir):
+    if source == 'artifacts':
+        (_, _, _, _, _, eq_vars), compiled_expr = load_free_variables(artifacts_dir, free_variables_file, network_name)
+        entry_nodes, exit_nodes = load_entry_exit_nodes(artifacts_dir, entries_exits_file, network_name)
+    else:
+        free_variables = get_free_variables(free_variables_file)[network_name]
+        compiled_expr = (fn.compile_list_expr(free_variables[2]), fn.compile_x_particular(free_variables[3]))
+        entry_nodes, exit_nodes = get_entry_exit_nodes(entries_exits_file, network_name)
+        eq_vars = get_eq_variables(network_name, equations_file)
+
+    return compiled_expr, entry_nodes, exit_nodes, eq_vars
+
+def benchmark_loading(config):
+    network_name = config.get('benchmark', 'NETWORK', fallback=config.get('nodes', 'NODE_ARTICLE', fallback='Article,./nodes/no_artigo.net.xml')).split(',')[0]
+    files = (config.get('nodes', 'FREE_VARIABLES', fallback='./nodes/free_variables.md'), config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md'), config.get('nodes', 'EQUATIONS', fallback='./nodes/equations.md'), config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts'))
+    repeats = int(config.get('benchmark', 'REPEATS', fallback='3'))
+
+    if load_artifact(files[-1], network_name, 'system') is None or load_artifact(files[-1], network_name, 'nodes') is None:
+        sys.exit(f"The artifacts of {network_name} were not found, run `make prepare` and `make solve` first")
+
+    print(f"\n::: Network inputs of {network_name} (best of {repeats}) :::\n")
+    results = {}
+    for source in ['markdown', 'artifacts']:
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            results[source] = load_network_inputs(source, network_name, *files)
+            times.append(time.perf_counter() - start_time)
+        print(f"{source}: {1000 * min(times):.1f} ms")
+
+    (b_ub, Xparticular), *nodes = results['markdown']
+    (artifact_b_ub, artifact_Xparticular), *artifact_nodes = results['artifacts']
+    identical = nodes == artifact_nodes and all(expr[0] == artifact_expr[0] and np.array_equal(expr[1], artifact_expr[1]) for expr, artifact_expr in [(b_ub, artifact_b_ub), (Xparticular, artifact_Xparticular)])
+    print(f"Identical inputs: {identical}")
+
+def get_ring_system(systems):
+    # the systems of all the networks side by side, with their variables renumbered, approximate the size of the whole VCI ring
+    equations, x_offset, q_offset = [], 0, 0
+    for _, _, network_equations in systems:
+        x_indices = [int(index) for eq in network_equations for index in re.findall(r'x(\d+)', eq)]
+        q_indices = [int(index) for eq in network_equations for index in re.findall(r'q(\d+)', eq)]
+        for eq in network_equations:
+            eq = re.sub(r'x(\d+)', lambda match: f'x{int(match.group(1)) + x_offset}', eq)
+            equations.append(re.sub(r'q(\d+)', lambda match: f'q{int(match.group(1)) + q_offset}', eq))
+        x_offset += max(x_indices) + 1
+        q_offset += max(q_indices) + 1 if q_indices else 0
+
+    return equations
+
+def benchmark_sensors(config):
+    network_name = config.get('benchmark', 'NETWORK', fallback=config.get('nodes', 'NODE_ARTICLE', fallback='Article,./nodes/no_artigo.net.xml')).split(',')[0]
+    data_file = config.get('sensors', 'DATA_ARTICLE', fallback='./data/article_data.xlsx') if network_name == 'Article' else config.get('sensors', 'DATA', fallback='./data/sensor_data')
+    _, node_sensors = get_node_sensors(config, network_name)
+
+    print(f"\n::: Sensor data of {network_name} ({len(node_sensors)} sensors) :::\n")
+    start_time = time.perf_counter()
+    timestamp_hours, sensors_data = get_sensors_data(network_name, node_sensors, data_file)
+    print(f"workbook: {time.perf_counter() - start_time:.2f}s")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ['first run (conversion)', 'later runs']:
+            start_time = time.perf_counter()
+            cached_timestamp_hours, cached_sensors_data = get_sensors_data(network_name, node_sensors, data_file, cache_dir)
+            print(f"cache, {run}: {time.perf_counter() - start_time:.3f}s")
+
+        identical = [row[0] for row in timestamp_hours] == list(cached_timestamp_hours[:, 0]) and all(np.array_equal(np.array(sensors_data[sensor_id], dtype=np.float64), cached_sensors_data[sensor_id]) for sensor_id in node_sensors.keys())
+        print(f"Identical sensor data: {identical}")
+        del cached_timestamp_hours, cached_sensors_data # the memory maps must be closed before the folder is removed
+
+def write_detector_export(export_file, days, vehicles_per_day, rng):
+    # a synthetic detector export with the columns of the VCI sensors, one row per vehicle
+    num_vehicles = days * vehicles_per_day
+    timestamps = pd.Timestamp('2023-05-01') + pd.to_timedelta(np.sort(rng.uniform(0, days * 86400, num_vehicles)), unit='s')
+    df = pd.DataFrame({
+        'MedidasCCVDetailId': np.arange(num_vehicles),
+        'SensorCCVId': rng.choice([73, 74, 75, 76, 77, 78], num_vehicles),
+        'VehicleTypeId': rng.choice([3, 4, 5, 6], num_vehicles, p=[0.05, 0.85, 0.07, 0.03]),
+        'Velocidade': rng.normal(80, 15, num_vehicles).round(),
+        'Timestamp': timestamps.floor('s'),
+    })
+    with pd.ExcelWriter(export_file, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name='Traffic', index=False)
+
+def benchmark_prepare(config):
+    num_sensors = int(config.get('benchmark', 'SENSORS', fallback='4'))
+    days = int(config.get('benchmark', 'DAYS', fallback='30'))
+    vehicles_per_day = int(config.get('benchmark', 'VEHICLES_PER_DAY', fallback='2000'))
+    rng = np.random.default_rng(0)
+
+    print(f"\n::: Sensor data preparation ({num_sensors} synthetic detector exports of {days} days, {vehicles_per_day} vehicles per day) :::\n")
+    with tempfile.TemporaryDirectory() as data_dir:
+        for i in range(num_sensors):
+            sensor_dir = Path(data_dir) / (f'CAV401-2;CAV401-1' if i == 0 else f'Sensor {i}') # the first sensor holds both directions
+            sensor_dir.mkdir()
+            write_detector_export(sensor_dir / 'data_1.xlsx', days, vehicles_per_day, rng)
+
+        results = {}
+        for workers in sorted({1, os.cpu_count()}):
+            start_time = time.perf_counter()
+            sheet_names = prepare_data(data_dir, f'{data_dir}/sensor_data_{workers}', workers)
+            results[workers] = time.perf_counter() - start_time
+        print()
+        for workers, elapsed in results.items():
+            print(f"{workers} worker(s): {elapsed:.2f}s")
+
+        start_time = time.perf_counter()
+        export_sensor_data(f'{data_dir}/sensor_data.xlsx', f'{data_dir}/sensor_data_1', sheet_names)
+        print(f"Excel export: {time.perf_counter() - start_time:.2f}s")
+
+        start_time = time.perf_counter()
+        sheets = load_sheets(f'{data_dir}/sensor_data_1', sheet_names)
+        print(f"Loading the binary sheets: {time.perf_counter() - start_time:.3f}s ({sum(len(values) for values in sheets.values())} rows)")
+        start_time = time.perf_counter()
+        workbook = pd.read_excel(f'{data_dir}/sensor_data.xlsx', sheet_name=None)
+        print(f"Loading the exported workbook: {time.perf_counter() - start_time:.2f}s")
+        identical = all(np.array_equal(load_sheets(f'{data_dir}/sensor_data_{workers}', sheet_names)[sheet_name], sheets[sheet_name]) for workers in results.keys() for sheet_name in sheet_names)
+        print(f"Identical sheets with any number of workers: {identical}")
+        del sheets, workbook # the memory maps must be closed before the folder is removed
+
+def benchmark_rref(config):
+    systems = get_equation_systems(config.get('nodes', 'EQUATIONS', fallback='./nodes/equations.md'))
+    equations = get_ring_system(systems)
+    repeats = int(config.get('benchmark', 'REPEATS', fallback='3'))
+
+    print(f"\n::: RREF engines on {len(systems)} networks ({len(equations)} equations side by side, best of {repeats}) :::\n")
+    results = {}
+    for rref in ['sympy', 'sparse']:
+        network_times = [min(solve_network(*system, rref=rref)[-1] for _ in range(repeats)) for system in systems]
+        ring_runs = [solve_network('Ring', len(equations), equations, rref=rref) for _ in range(repeats)]
+        results[rref] = min(ring_runs, key=lambda run: run[-1])
+        print(f"{rref}: {sum(network_times):.3f}s for the networks one by one, {results[rref][-1]:.3f}s for the ring system")
+
+    print(f"Identical solutions: {results['sympy'][:-1] == results['sparse'][:-1]}")
+
+def benchmark_backend(config):
+    network_name, _, network, entry_nodes, exit_nodes, sensors_edges = load_network(config)
+    sumo_cmd = get_headless_cmd(config, network_name)
+    seconds = int(config.get('benchmark', 'SECONDS', fallback='1800'))
+    step_length = float(config.get('params', 'STEP_LENGTH', fallback='0.25'))
+    repeats = int(config.get('benchmark', 'REPEATS', fallback='3'))
+
+    print(f"\n::: Simulation backends on {network_name} ({seconds} simulated seconds, best of {repeats}) :::\n")
+    results = {}
+    for backend in BACKENDS:
+        traci.use(backend)
+        runs = [run_counting(sumo_cmd, network, entry_nodes, exit_nodes, sensors_edges, 'subscription', seconds, step_length) for _ in range(repeats)]
+        results[backend] = max(runs, key=lambda run: run[0])
+        print(f"{backend}: {results[backend][0] * step_length:.1f} simulated seconds per second")
+
+    traci.use(config.get('params', 'BACKEND', fallback='traci'))
+    print(f"Speedup: {results['libsumo'][0] / results['traci'][0]:.2f}x")
+    print(f"Identical per-minute flows: {results['libsumo'][2] == results['traci'][2]}")
+
+def benchmark_output(config):
+    hours = int(config.get('benchmark', 'HOURS', fallback='24'))
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.integers(0, 3000, (60, 25)).astype(np.float64), columns=[f'f_E{i}' for i in range(24)] + ['TTS']) # the shape of an hour of results of the Article network
+    save_data_times = [(pd.Timestamp('2022-03-24') + pd.Timedelta(hours=hour)).strftime('%Y-%m-%d-%H-%M') for hour in range(hours)]
+
+    print(f"\n::: Output formats ({hours} hourly results files) :::\n")
+    for output_format in RESULTS_FORMATS.keys():
+        try:
+            check_results_format(output_format)
+        except Exception as e:
+            print(f"{output_format}: skipped ({e})")
+            continue
+
+        with tempfile.TemporaryDirectory() as results_dir:
+            start_time = time.perf_counter()
+            for save_data_time in save_data_times:
+                write_results(df, get_results_file(results_dir, 'Article', save_data_time, output_format))
+            write_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            results = read_results(results_dir)
+            read_time = time.perf_counter() - start_time
+
+            size = sum(file.stat().st_size for file in Path(results_dir).rglob('*') if file.is_file())
+            identical = list(results.keys()) == save_data_times and all(list(result.columns) == list(df.columns) and np.array_equal(result.to_numpy(), df.to_numpy()) for result in results.values()) # Excel reads the whole floats back as integers
+            print(f"{output_format}: {write_time:.2f}s to write, {read_time:.2f}s to read, {size / 1024:.0f} KiB, identical: {identical}")
+
+def benchmark_calibrators(config):
+    network_name, network_file = config.get('benchmark', 'NETWORK', fallback=config.get('nodes', 'NODE_ARTICLE', fallback='Article,./nodes/no_artigo.net.xml')).split(',')
+    network = sumolib.net.readNet(network_file)
+    _, node_sensors = get_node_sensors(config, network_name)
+    entry_nodes, _, routers, _, _, _ = initialize_variables(network_name, network_file, node_sensors, config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md'), config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts'))
+    hours = int(config.get('benchmark', 'HOURS', fallback='24'))
+    repeats = int(config.get('benchmark', 'REPEATS', fallback='3'))
+
+    print(f"\n::: SUMO loading with the calibrator definitions of {network_name} (best of {repeats}) :::\n")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        routes_file, flows_file, calibrators_file = f'{tmp_dir}/routes.xml', f'{tmp_dir}/flows.xml', f'{tmp_dir}/calibrators.add.xml'
+        generate_routes(routes_file, routers, network)
+        generate_flows(flows_file, entry_nodes, routers, network)
+        sumo_cmd = get_isolated_sumo_cmd(prepare_sumo(config, network_name), network_file, [f"{config.get('dir', 'SUMO', fallback='./sumo')}/vtype_distribution.add.xml", routes_file, flows_file, calibrators_file], f'{tmp_dir}/sim.log')
+
+        for name in ['compact', f'{hours}h of flows']:
+            start_time = time.perf_counter()
+            generate_calibrators(calibrators_file, entry_nodes, routers, network, tmp_dir)
+            if name != 'compact': # the definition written before the flows were set at runtime
+                replay_calibrators(calibrators_file, {}, {}, hours * 60)
+            write_time = time.perf_counter() - start_time
+
+            times = []
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                traci.start(sumo_cmd)
+                traci.simulationStep()
+                times.append(time.perf_counter() - start_time)
+                traci.close()
+            print(f"{name}: {Path(calibrators_file).stat().st_size / 1024:.0f} KiB written in {1000 * write_time:.0f} ms, SUMO loaded in {1000 * min(times):.0f} ms")
+
+BENCHMARKS = {
+    'counting': benchmark_counting,
+    'lifecycle': benchmark_lifecycle,
+    'sampler': benchmark_sampler,
+    'loading': benchmark_loading,
+    'sensors': benchmark_sensors,
+    'prepare': benchmark_prepare,
+    'rref': benchmark_rref,
+    'backend': benchmark_backend,
+    'output': benchmark_output,
+    'calibrators': benchmark_calibrators,
+}
+
+if __name__ == '__main__':
+    config = load_config()
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark '{name}', choose from {list(BENCHMARKS.keys())}")
+        BENCHMARKS[name](config)
@@ -8,21 +8,25 @@ import os, sys, time
 import numpy as np
 import pandas as pd
 import json
-import traci
 import pickle
 import sumolib
 from pathlib import Path
 from datetime import datetime
 import xml.etree.cElementTree as ET
+from xml.sax.saxutils import quoteattr
+from concurrent.futures import ProcessPoolExecutor
 
-from .utils import load_config, get_eq_variables, get_network_sensors, get_sensors_coverage, get_free_variables, get_entry_exit_nodes, get_calibrators, get_probability_distributions, write_xml
+from .utils import load_config, get_eq_variables, get_network_sensors, get_sensors_coverage, load_free_variables, load_entry_exit_nodes, get_calibrators, get_compositions, get_split_percentages, get_route_distribution_id, write_xml, load_sheets, load_sheets_cache, check_results_format, get_results_file, write_results, get_node_filename, get_inputs_hash
+from .backend import traci
+from .profiler import profiler
+from .metrics import new_metrics_state, collect_metrics, write_metrics
 import src.logic_functions as fn
 
 # TODO: Initialization of the variables
 # - for each permanent distribution, set an array with an array with two empty arrays and an array with a 0 element -> done
 # - for each sensor, set two zeroed arrays of size 4 (carFlows, carSpeed, truckFlows, truckSpeed), for the new and old values -> done
 # - for each entry and exit, set an empty array -> done
-def initialize_variables(network_name, network_file, node_sensors, entries_exits_file):
+def initialize_variables(network_name, network_file, node_sensors, entries_exits_file, artifacts_dir=None):
     tree = ET.parse(network_file.replace('.net', '_poi'))
     root = tree.getroot()
 
@@ -39,10 +43,10 @@ def initialize_variables(network_name, network_file, node_sensors, entries_exits
         sensors[sensor] = [[0,0,0,0], [0,0,0,0], node_sensors[sensor]]
 
     # store the IDs of the vehicles that entered and exited the network
-    oldVehIDs = {} # node_id : [vehIDs]
-    entry_nodes, exit_nodes = get_entry_exit_nodes(entries_exits_file, network_name)
+    oldVehIDs = {} # node_id : {vehIDs}
+    entry_nodes, exit_nodes = load_entry_exit_nodes(artifacts_dir, entries_exits_file, network_name)
     for node in entry_nodes + exit_nodes:
-        oldVehIDs[node] = []
+        oldVehIDs[node] = set()
 
     return entry_nodes, exit_nodes, routers, perm_dists, sensors, oldVehIDs
 
@@ -75,7 +79,7 @@ def get_node(network, flow_speed_min, edge_id):
         elif flow_speed_min[node][0] == 'out' and edge_id in get_linear_edges(network, network.getNode(node).getIncoming()[0].getID()):
             return node
 
-def get_entry_exit_variables(entry_nodes, exit_nodes, variables):
+def get_entry_exit_variables(network, entry_nodes, exit_nodes, variables):
     entry_exit_variables = {} # edge_id : (variable, flow)
     for node in entry_nodes:
         edge_id = network.getNode(node).getOutgoing()[0].getID()
@@ -86,6 +90,17 @@ def get_entry_exit_variables(entry_nodes, exit_nodes, variables):
 
     return entry_exit_variables
 
+def get_node_sensors(config, network_name):
+    network_sensors_file = config.get('nodes', 'SENSORS', fallback='./nodes/network_sensors.md')
+    coverage_file = config.get('sensors', 'COVERAGE', fallback='./sumo/coverage.md')
+
+    sensors_coverage = get_sensors_coverage(coverage_file)
+    node_sensors = {} # sensor_id : lane_id
+    for sensor_id in get_network_sensors(network_sensors_file)[network_name]:
+        node_sensors[sensor_id] = sensors_coverage[sensor_id][0]
+
+    return sensors_coverage, node_sensors
+
 def get_sensors_edges(network, sensors):
     sensors_edges = {} # edge_id : [sensor_id]
     for sensor, values in sensors.items():
@@ -102,17 +117,37 @@ def get_covered_calibrators(calibrators, sensors_edges, covered_edges):
     
     return covered_calibrators
 
-def get_sensors_data(network_name, sensors, data_file):
+def get_sensor_sheet_name(network_name, sensor_id):
+    return sensor_id.replace('CH', 'X').replace(':', '_').replace('.', '_') if network_name == 'Article' else sensor_id.replace('/', ';')
+
+def get_sensors_data(network_name, sensors, data_file, cache_dir=None):
+    # with a `cache_dir`, or a folder of sheets written by `prepare_data`, the timestamps and the (minutes x 4) values of each sensor are memory-mapped arrays instead of lists
+    if cache_dir or Path(data_file).is_dir():
+        sheet_names = {sensor_id: get_sensor_sheet_name(network_name, sensor_id) for sensor_id in sensors.keys()}
+        sheet_names_list = ['timestamp'] + list(sheet_names.values())
+        sheets = load_sheets(data_file, sheet_names_list) if Path(data_file).is_dir() else load_sheets_cache(cache_dir, data_file, sheet_names_list)
+        return sheets['timestamp'], {sensor_id: sheets[sheet_name] for sensor_id, sheet_name in sheet_names.items()}
+
     sensors_dfs = {} # id : dataframe
     df_timestamp = pd.read_excel(data_file, sheet_name='timestamp').values.tolist()
     
     for sensor_id in sensors.keys():
-        sheet_name = sensor_id.replace('CH', 'X').replace(':', '_').replace('.', '_') if network_name == 'Article' else sensor_id.replace('/', ';')
+        sheet_name = get_sensor_sheet_name(network_name, sensor_id)
         dataframe = pd.read_excel(data_file, sheet_name=sheet_name).values.tolist()
         sensors_dfs[sensor_id] = dataframe
 
     return df_timestamp, sensors_dfs
 
+def get_minute_variables_values(sensors_edges, sensors_data, variables, minute):
+    # total flow (cars + trucks) of the variables of the sensor edges, read from the real data of the given minute
+    variables_values = {} # variable : [flow, speed]
+    for edge_id in sensors_edges.keys():
+        variables_values[variables[edge_id]['root_var']] = [0, 0]
+        for sensor_id in sensors_edges[edge_id]:
+            variables_values[variables[edge_id]['root_var']][0] += sensors_data[sensor_id][minute][0] + sensors_data[sensor_id][minute][2]
+
+    return variables_values
+
 def get_week_days(timestamp_hours):
     days = set()
     weekdays = []
@@ -126,6 +161,9 @@ def get_week_days(timestamp_hours):
     
     return weekdays
 
+def get_headless_binary(sumo_binary):
+    return sumo_binary.replace('sumo-gui', 'sumo')
+
 def prepare_sumo(config, network_name):
     if 'SUMO_HOME' in os.environ:
         tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -134,10 +172,18 @@ def prepare_sumo(config, network_name):
         sys.exit("Please declare environment variable 'SUMO_HOME'")
 
     sumo_binary = config.get('sumo', 'BINARY', fallback='sumo-gui.exe')
+    if config.get('params', 'BACKEND', fallback='traci') == 'libsumo': # libsumo embeds the simulation and cannot show the GUI
+        sumo_binary = get_headless_binary(sumo_binary)
     sumo_config = config.get('sumo', 'CONFIG_ARTICLE', fallback='./sumo/article.sumocfg') if network_name == 'Article' else config.get('sumo', 'CONFIG', fallback='./sumo/vci.sumocfg')
 
     return [sumo_binary, '-c', sumo_config, '--seed', str(28815), '--start', '1', '--quit-on-end', '1']
 
+def get_isolated_sumo_cmd(sumo_cmd, network_file, additional_files, log_file):
+    # the command line options take precedence over the configuration file, so each network runs headless on its own files
+    sumo_cmd = list(sumo_cmd)
+    sumo_cmd[0] = get_headless_binary(sumo_cmd[0])
+    return sumo_cmd + ['--net-file', network_file, '--additional-files', ','.join(additional_files), '--log', log_file, '--no-step-log', 'true']
+
 def reset_flow_speed_min(entry_nodes, exit_nodes):
     # reset the variables for the flow and speed in each entry and exit during the current minute
     flow_speed_min = {} # node_id : (in/out, flow, speed)
@@ -213,6 +259,33 @@ def get_counting_edges_exits(initial_edge, sensors_edges):
 
     return start_edge, next_edge
 
+def index_counting_edges(network, entry_nodes, exit_nodes, sensors_edges):
+    entry_counting_edges, exit_counting_edges = {}, {} # node_id : (start_edge_id, next_edge_id)
+    for node in entry_nodes:
+        start_edge, next_edge = get_counting_edges(network.getNode(node).getOutgoing()[0], sensors_edges)
+        entry_counting_edges[node] = (start_edge.getID(), next_edge.getID())
+    for node in exit_nodes:
+        start_edge, next_edge = get_counting_edges_exits(network.getNode(node).getIncoming()[0], sensors_edges) # select edges with sensors closest to the exits
+        exit_counting_edges[node] = (start_edge.getID(), next_edge.getID())
+
+    return entry_counting_edges, exit_counting_edges
+
+def index_edge_nodes(network, entry_nodes, exit_nodes):
+    edge_nodes = {} # edge_id : node_id
+    for node, (direction, _, _) in reset_flow_speed_min(entry_nodes, exit_nodes).items(): # same precedence as the node search of `get_node`
+        edge_id = network.getNode(node).getOutgoing()[0].getID() if direction == 'in' else network.getNode(node).getIncoming()[0].getID()
+        for linear_edge in get_linear_edges(network, edge_id):
+            edge_nodes.setdefault(linear_edge, node)
+
+    return edge_nodes
+
+def build_topology_index(network, entry_nodes, exit_nodes, sensors_edges):
+    # the counting edges of each entry/exit and the node owning each edge do not change during a run, so they are computed only once
+    entry_counting_edges, exit_counting_edges = index_counting_edges(network, entry_nodes, exit_nodes, sensors_edges)
+    edge_nodes = index_edge_nodes(network, entry_nodes, exit_nodes)
+
+    return entry_counting_edges, exit_counting_edges, edge_nodes
+
 def get_splitting_edge(router_edge):
     following_edges = list(router_edge.getOutgoing().keys())
     splitting_edge = router_edge
@@ -227,7 +300,18 @@ def get_splitting_edge(router_edge):
 
     return splitting_edge
 
-def generate_calibrators(calibrators_file, entry_nodes, routers, network):
+def get_split_edges(router_edge):
+    return [edge.getID() for edge in get_splitting_edge(router_edge).getOutgoing().keys()]
+
+def get_route_distribution(router_routes, router_edge, percentages):
+    # ([route_ids], probabilities) of a router for the percentages of the branches of its split
+    route_ids, branches = router_routes[router_edge]
+    routes_per_branch = np.bincount(branches, minlength=len(percentages))
+    return route_ids, np.array([percentages[branch] / routes_per_branch[branch] for branch in branches]) / 100
+
+CALIBRATOR_DEFAULT_FLOW = (180, 27.78) # vehsPerHour, speed of the calibrator minutes whose flow is not set
+
+def generate_calibrators(calibrators_file, entry_nodes, routers, network, output_dir):
     additional_tag = ET.Element('additional')
     calib_routes = {} # calibrator_id : route_id
 
@@ -253,10 +337,9 @@ def generate_calibrators(calibrators_file, entry_nodes, routers, network):
         calib_car_tag = ET.SubElement(additional_tag, 'calibrator', id=f'calib_car_{entry}', vTypes='vtype_car', edge=calibrator_edge.getID(), pos=str(calib_pos), jamThreshold='0.5', output=output_file_car)
         calib_truck_tag = ET.SubElement(additional_tag, 'calibrator', id=f'calib_truck_{entry}', vTypes='vtype_truck', edge=calibrator_edge.getID(), pos=str(calib_pos), jamThreshold='0.5', output=output_file_truck)
 
-        for begin_time in range(0, 86400, 60):
-            end_time = begin_time + 60
-            ET.SubElement(calib_car_tag, 'flow', begin=str(begin_time), end=str(end_time), route=route_name, vehsPerHour='180', speed='27.78', type='vtype_car', departPos='random_free', departSpeed='max')
-            ET.SubElement(calib_truck_tag, 'flow', begin=str(begin_time), end=str(end_time), route=route_name, vehsPerHour='180', speed='27.78', type='vtype_truck', departPos='random_free', departSpeed='max')
+        # only the first minute is defined, the following ones are added at runtime (or written by `replay_calibrators`)
+        ET.SubElement(calib_car_tag, 'flow', begin='0', end='60', route=route_name, vehsPerHour=str(CALIBRATOR_DEFAULT_FLOW[0]), speed=str(CALIBRATOR_DEFAULT_FLOW[1]), type='vtype_car', departPos='random_free', departSpeed='max')
+        ET.SubElement(calib_truck_tag, 'flow', begin='0', end='60', route=route_name, vehsPerHour=str(CALIBRATOR_DEFAULT_FLOW[0]), speed=str(CALIBRATOR_DEFAULT_FLOW[1]), type='vtype_truck', departPos='random_free', departSpeed='max')
 
         calib_routes[f'calib_car_{entry}'] = route_name
         calib_routes[f'calib_truck_{entry}'] = route_name
@@ -265,6 +348,41 @@ def generate_calibrators(calibrators_file, entry_nodes, routers, network):
 
     return calib_routes
 
+def get_covered_calibrator_flow(sensor_values, flow_idx, speed_idx):
+    # vehsPerHour and speed of a calibrator from the [car flow, car speed, truck flow, truck speed] of a minute of its sensors
+    v_calib = [values[speed_idx] / 3.6 for values in sensor_values]
+    x = 0.001 + sum(v > 0 for v in v_calib)
+    vehsPerHour = 0
+    for values in sensor_values:
+        vehsPerHour += values[flow_idx]
+
+    return vehsPerHour, sum(v_calib) / x
+
+def replay_calibrators(calibrators_file, covered_calibrators, sensors_data, minutes):
+    # the compact calibrators file is rewritten with a flow for every minute, so that the network can also run without the control loop:
+    # the calibrators covered by sensors replay their data, the others keep the default flow
+    additional_tag = ET.parse(calibrators_file).getroot()
+    with open(calibrators_file, 'w', encoding='UTF-8') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n<additional>\n")
+        for element in additional_tag:
+            if element.tag != 'calibrator':
+                f.write(f"\t{ET.tostring(element, encoding='unicode').strip()}\n")
+                continue
+
+            calib_id, flow = element.get('id'), element.find('flow').attrib
+            f.write(f"\t<calibrator {' '.join(f'{key}={quoteattr(value)}' for key, value in element.attrib.items())}>\n")
+            sensor_ids = covered_calibrators.get(calib_id, [])
+            flow_idx, speed_idx = (0, 1) if '_car_' in calib_id else (2, 3)
+            for minute in range(minutes):
+                if sensor_ids and all(minute < len(sensors_data[sensor_id]) for sensor_id in sensor_ids):
+                    vehsPerHour, speed = get_covered_calibrator_flow([sensors_data[sensor_id][minute] for sensor_id in sensor_ids], flow_idx, speed_idx)
+                else:
+                    vehsPerHour, speed = CALIBRATOR_DEFAULT_FLOW
+                speed = speed if speed > 0 else CALIBRATOR_DEFAULT_FLOW[1] # a zero speed would close the edge to the vehicles routed through it
+                f.write(f'\t\t<flow begin="{minute * 60}" end="{(minute + 1) * 60}" route={quoteattr(flow["route"])} vehsPerHour="{vehsPerHour}" speed="{speed}" type={quoteattr(flow["type"])} departPos="random_free" departSpeed="max" />\n')
+            f.write('\t</calibrator>\n')
+        f.write('</additional>\n')
+
 def generate_flows(flows_file, entry_nodes, routers, network):
     routes_tag = ET.Element('routes')
     routes_tag.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
@@ -279,13 +397,14 @@ def generate_flows(flows_file, entry_nodes, routers, network):
 
     write_xml(routes_tag, flows_file) 
 
-def generate_routes(routes_file, routers, network):
+def generate_routes(routes_file, routers, network, distributions=True):
     routes_tag = ET.Element('routes')
     routes_tag.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
     routes_tag.set('xsi:noNamespaceSchemaLocation', 'http://sumo.dlr.de/xsd/routes_file.xsd')
 
     colors = ['red', 'green', 'blue', 'yellow', 'cyan', 'magenta', 'white', 'black', 'gray', 'lightgray', 'darkgray', 'orange', 'brown', 'purple', 'pink']
 
+    router_routes = {} # router_edge : ([route_ids], [branch of each route])
     router_edges = [routers[router][2] for router in routers]
     for r, router in enumerate(routers):
         router_edge = routers[router][2]
@@ -293,16 +412,23 @@ def generate_routes(routes_file, routers, network):
         for i, path in enumerate(paths):
             ET.SubElement(routes_tag, 'route', id=f'route_{router_edge}_{i}', edges=path, color=colors[r % len(colors)])
 
-        distributions = get_probability_distributions(len(paths))
+        # the percentages of a distribution are those of the branches of the split, shared by the routes that go through each branch
+        split_edges = get_split_edges(network.getEdge(router_edge))
+        branches = [next(i for i, edge_id in enumerate(split_edges) if edge_id in path.split()) for path in paths]
+        router_routes[router_edge] = ([f'route_{router_edge}_{i}' for i in range(len(paths))], branches)
 
-        for dist in distributions:
-            dist_id = f'routedist_{router_edge}' + ''.join([f'_{int(d*100)}' for d in dist])
-            route_dist_tag = ET.SubElement(routes_tag, 'routeDistribution', id=dist_id)
-            for i, path in enumerate(paths):
-                ET.SubElement(route_dist_tag, 'route', refId=f'route_{router_edge}_{i}', probability=f'{dist[i]}')
+        if not distributions: # the distributions are then created at runtime, only for the percentages that are used
+            continue
+        for tenths in get_compositions(10, len(split_edges)):
+            percentages = [tenth * 10 for tenth in tenths]
+            route_dist_tag = ET.SubElement(routes_tag, 'routeDistribution', id=get_route_distribution_id(router_edge, percentages))
+            for route_id, probability in zip(*get_route_distribution(router_routes, router_edge, percentages)):
+                ET.SubElement(route_dist_tag, 'route', refId=route_id, probability=f'{probability:g}')
 
     write_xml(routes_tag, routes_file)
 
+    return router_routes
+
 def get_possible_paths(edge_id, router_edges, network):
     paths = []
 
@@ -325,54 +451,304 @@ def get_possible_paths(edge_id, router_edges, network):
 
     return paths
 
-if __name__ == '__main__':
-    config = load_config()
-    network_name, network_file = config.get('nodes', 'NODE_ARTICLE', fallback='./nodes/no_artigo.net.xml').split(',') # TODO: set the node that we want to analyse in the Makefile
-    # network_name, network_file = config.get('nodes', 'NODE_COIMBROES', fallback='./nodes/no_coimbroes.net.xml').split(',') # TODO: set the node that we want to analyse in the Makefile
+def get_result_schema(sensors_edges, entry_exit_variables, sensors_coverage, variables, edge_nodes, free_variables_order, eq_variables):
+    # the columns of the hourly results are fixed for a network, so their sources are resolved once: the sensor edges, the TTS, then the remaining entry and exit edges
+    schema = [('sensor', edge_id, variables[edge_id]['root_var'], edge_nodes.get(edge_id)) for edge_id in sorted(sensors_edges.keys())] # [(source, edge_id, key, node)]
+    schema.append(('TTS', None, None, None))
+    for edge_id in sorted(entry_exit_variables.keys()):
+        if not any(edge_id in lst[1] for lst in sensors_coverage.values()):
+            root_var = variables[edge_id]['root_var']
+            if root_var in free_variables_order:
+                schema.append(('free', edge_id, free_variables_order.index(root_var), edge_nodes.get(edge_id)))
+            else:
+                schema.append(('eq', edge_id, eq_variables.index(root_var), edge_nodes.get(edge_id)))
+
+    return schema
+
+def new_results_buffer(result_schema, rows=60):
+    # one row per minute of the hour, with the reference and simulated flows of each edge as named columns
+    columns = []
+    for source, edge_id, _, _ in result_schema:
+        columns.extend(['TTS'] if source == 'TTS' else [f'f_{edge_id}_ref', f'f_{edge_id}'])
+
+    return np.zeros(rows, dtype=[(column, np.float64) for column in columns])
+
+def record_minute(results_buffer, row, result_schema, variables_values, flow_speed_min, TTS, X_free, Xcomplete):
+    values = []
+    for source, _, key, node in result_schema:
+        if source == 'TTS':
+            values.append(round(TTS)) # TODO: understand what TTS means and how it is updated
+        elif source == 'sensor':
+            values.extend([variables_values[key][0], flow_speed_min[node][1] * 60])
+        elif source == 'free':
+            values.extend([X_free[key], flow_speed_min[node][1] * 60])
+        else:
+            values.extend([Xcomplete[key][0], flow_speed_min[node][1] * 60])
+
+    if row == len(results_buffer): # only if an hour has more minutes than expected
+        results_buffer = np.concatenate([results_buffer, np.zeros_like(results_buffer)])
+    results_buffer[row] = tuple(values)
+
+    return results_buffer, row + 1
+
+def flush_results(results_buffer, rows, results_file):
+    # each hour is written once to its own file, and the buffer is reused for the next hour
+    return write_results(pd.DataFrame(results_buffer[:rows]), results_file)
+
+CONTROL_FALLBACKS = ['last', 'projection', 'vectorized'] # once the budget of a minute is exhausted: the previous solution, the projection of the last candidate onto the feasible set, a single run of the vectorized sampler
+
+def new_solve_stats():
+    # minutes solved, repetitions of their sampling, minutes that exhausted the budget and the fallback that solved them ('clipped' when none did)
+    return {'minutes': 0, 'retries': 0, 'exhausted': 0, **{f'fallback_{fallback}': 0 for fallback in CONTROL_FALLBACKS + ['clipped']}}
+
+solve_stats = new_solve_stats() # cumulative over the minutes solved by this process, reset by `run_network`
+
+def get_control_budget(config):
+    # the samplers can only be stopped between attempts, so an attempt that has started always finishes
+    fallbacks = [fallback.strip() for fallback in config.get('params', 'CONTROL_FALLBACKS', fallback=','.join(CONTROL_FALLBACKS)).split(',') if fallback.strip()]
+    unknown = set(fallbacks) - set(CONTROL_FALLBACKS)
+    if unknown:
+        raise Exception(f"Unknown control fallbacks {sorted(unknown)}, choose from {CONTROL_FALLBACKS}")
+
+    return {'attempts': int(config.get('params', 'CONTROL_MAX_ATTEMPTS', fallback='5')), 'seconds': float(config.get('params', 'CONTROL_BUDGET', fallback='30')), 'fallbacks': fallbacks} # 0 attempts or seconds lifts that limit
+
+def solve_fallback(variables_values, free_variables_target, free_variables_order, network_free_variables, b_con_expr, Xparticular_expr, num_samples, last_free_solution, candidate, Xparticular, fallbacks, projection_norm='l1'):
+    solve_stats['exhausted'] += 1
+    A_con, b_con, Xnull = network_free_variables[1], fn.calc_list_expr(b_con_expr, variables_values), network_free_variables[4]
+    for fallback in fallbacks:
+        if fallback == 'last':
+            free_solution = last_free_solution
+        elif fallback == 'projection':
+            free_solution = fn.projectFreeVariables(candidate, A_con, b_con, Xparticular, Xnull, projection_norm)
+        else:
+            free_solution, _, _ = fn.vectorizedFreeVarRange(variables_values, free_variables_order, free_variables_target, A_con, b_con_expr, Xparticular_expr, Xnull, num_samples, warm_start=last_free_solution)
+
+        if free_solution is not None and fn.feasibleFreeVariables(np.reshape(free_solution, (-1, 1)), np.array(A_con, dtype=np.float64), b_con, Xparticular, np.array(Xnull, dtype=np.float64))[0]: # within the constraints of the free variables, not only with non-negative flows
+            solve_stats[f'fallback_{fallback}'] += 1
+            print(f"The control budget of the minute was exhausted, using the '{fallback}' fallback")
+            return np.ravel(free_solution), fn.calc_x_complete(free_variables_target, Xparticular, Xnull, np.ravel(free_solution))
+
+    # the flows of the equation system cannot be negative, so those of the last candidate are clipped
+    solve_stats['fallback_clipped'] += 1
+    print("The control budget of the minute was exhausted and no fallback was feasible, clipping the negative flows")
+    return candidate, np.maximum(fn.calc_x_complete(free_variables_target, Xparticular, Xnull, candidate), 0)
+
+def solve_minute(variables_values, free_variables_target, free_variables_order, network_free_variables, b_con_expr, Xparticular_expr, sampler, num_simplex_runs, num_samples, last_free_solution=None, budget=None, projection_norm='l1'):
+    # without a `budget`, the minute is sampled again until the complete solution is non-negative
+    Xnull = network_free_variables[4]
+    solve_stats['minutes'] += 1
+    start_time, attempts = time.perf_counter(), 0
+    while True:
+        # TODO: calculate the closest feasible error, that gives the values for the free variables -> done
+        if sampler == 'vectorized':
+            closest_feasible_X_free_relative_error, targets, Xparticular = fn.vectorizedFreeVarRange(variables_values, free_variables_order, free_variables_target, network_free_variables[1], b_con_expr, Xparticular_expr, Xnull, num_samples, warm_start=last_free_solution)
+        elif sampler == 'projection':
+            closest_feasible_X_free_relative_error, targets, Xparticular = fn.projectedFreeVarRange(variables_values, free_variables_order, free_variables_target, network_free_variables[1], b_con_expr, Xparticular_expr, Xnull, projection_norm)
+        else:
+            closest_feasible_X_free_relative_error, targets, Xparticular = fn.restrictedFreeVarRange(variables_values, free_variables_order, free_variables_target, network_free_variables[1], b_con_expr, Xparticular_expr, Xnull, num_simplex_runs)
+
+        # TODO: calculate the solution for the entire equation system (Xcomplete), by defining the matrices Xparticular and Xnull -> done
+        Xnull_cols = []
+        for i in range(len(free_variables_target)):
+            Xnull_cols.append(np.array([[row[i]] for row in Xnull]))
+
+        Xcomplete = Xparticular.astype(np.float64)
+        for i in range(len(free_variables_target)):
+            Xcomplete += closest_feasible_X_free_relative_error[i] * Xnull_cols[i]
+
+        # TODO: if all variables are positive, break the loop (solution found?) -> done
+        if np.all(Xcomplete >= 0):
+            return closest_feasible_X_free_relative_error, Xcomplete
+
+        attempts += 1
+        if sampler == 'projection' or (budget and ((budget['attempts'] and attempts >= budget['attempts']) or (budget['seconds'] and time.perf_counter() - start_time >= budget['seconds']))): # the projection would give the same solution again
+            return solve_fallback(variables_values, free_variables_target, free_variables_order, network_free_variables, b_con_expr, Xparticular_expr, num_samples, last_free_solution, closest_feasible_X_free_relative_error, Xparticular, budget['fallbacks'] if budget else CONTROL_FALLBACKS, projection_norm)
+        solve_stats['retries'] += 1
+
+def get_calibrator_vtype(calib_id):
+    return 'vtype_car' if '_car_' in calib_id else 'vtype_truck'
+
+def get_calibrator_setpoints(calibrators, covered_calibrators, sensor_values, variables, free_variables_order, eq_variables, closest_feasible_X_free_relative_error, Xcomplete):
+    # calibrator_id : (vehsPerHour, speed, vType) of a minute, from the sensors of the calibrator when it is covered, otherwise from the solution of the equation system
+    setpoints = {}
+    for calib_id in calibrators.keys():
+        veh_type = get_calibrator_vtype(calib_id)
+        root_var = variables[calibrators[calib_id]]['root_var']
+        if calib_id in covered_calibrators.keys():
+            flow_idx, speed_idx = (0, 1) if veh_type == 'vtype_car' else (2, 3)
+            setpoints[calib_id] = (*get_covered_calibrator_flow([sensor_values[sensor_id] for sensor_id in covered_calibrators[calib_id]], flow_idx, speed_idx), veh_type)
+        elif veh_type == 'vtype_truck': # TODO: porquê que mete o fluxo a zero para trucks?
+            setpoints[calib_id] = (0, 22.22, veh_type)
+        elif root_var in free_variables_order:
+            setpoints[calib_id] = (closest_feasible_X_free_relative_error[free_variables_order.index(root_var)], 22.22, veh_type)
+        else:
+            setpoints[calib_id] = (Xcomplete[eq_variables.index(root_var)], 22.22, veh_type)
+
+    return setpoints
+
+def get_router_percentages(routers, router_splits, variables, variables_values, eq_variables, Xcomplete):
+    prob_dists = {} # router_id : {edge_id : prob_dist}
+    for router in routers.keys():
+        var = variables[routers[router][2]]['root_var']
+        if var.startswith('q'):
+            var_value = variables_values[var][0]
+        elif var.startswith('x'):
+            var_value = float(Xcomplete[eq_variables.index(var)][0])
+
+        if var_value != 0:
+            shares = [float(Xcomplete[eq_variables.index(variables[edge_id]['root_var'])][0]) / var_value for edge_id in router_splits[router]]
+        else:
+            shares = [1 / len(router_splits[router])] * len(router_splits[router])
+        prob_dists[router] = dict(zip(router_splits[router], get_split_percentages(shares)))
+
+    return prob_dists
+
+SCHEDULE_SEED = 28815 # the random numbers of each hour of the schedule are drawn from this seed plus its first minute
+
+def solve_schedule_minutes(inputs, first_minute, sensors_rows):
+    # the minutes of an hour are solved in order, each one warm started from the previous one as in the control loop
+    np.random.seed(SCHEDULE_SEED + first_minute)
+    solve_start, lp_start = dict(solve_stats), dict(fn.lp_stats) # the counters of a worker process also hold the hours it solved before
+    last_free_solution = None
+    network_free_variables = inputs['free_variables']
+    free_variables_order = sorted(network_free_variables[0], key=lambda x: int(x[1:]))
+    rows = {'free': [], 'Xcomplete': [], 'calibrators': [], 'percentages': []}
+    for i in range(len(next(iter(sensors_rows.values())))):
+        hour = max(first_minute + i - 1, 0) // 60 # the minute that ends an hour is still solved with the targets of that hour
+        variables_values = get_minute_variables_values(inputs['sensors_edges'], sensors_rows, inputs['variables'], i)
+        free_variables_target = {var: inputs['intensities'][inputs['week_days'][hour // 24]][var][hour % 24] for var in network_free_variables[0]}
+        free_solution, Xcomplete = solve_minute(variables_values, free_variables_target, free_variables_order, network_free_variables, inputs['b_con_expr'], inputs['Xparticular_expr'], inputs['sampler'], inputs['num_simplex_runs'], inputs['num_samples'], last_free_solution, inputs['budget'], inputs['projection_norm'])
+        last_free_solution = free_solution
+
+        setpoints = get_calibrator_setpoints(inputs['calibrators'], inputs['covered_calibrators'], {sensor_id: values[i] for sensor_id, values in sensors_rows.items()}, inputs['variables'], free_variables_order, network_free_variables[5], free_solution, Xcomplete)
+        prob_dists = get_router_percentages(inputs['routers'], inputs['router_splits'], inputs['variables'], variables_values, inputs['eq_variables'], Xcomplete)
+        rows['free'].append(np.asarray(free_solution, dtype=np.float64))
+        rows['Xcomplete'].append(np.asarray(Xcomplete, dtype=np.float64))
+        rows['calibrators'].append([(float(np.ravel(vehsPerHour)[0]), float(speed)) for vehsPerHour, speed, _ in setpoints.values()])
+        rows['percentages'].append([list(prob_dists[router].values()) + [-1] * (inputs['max_branches'] - len(prob_dists[router])) for router in inputs['routers'].keys()])
+
+    stats = {name: solve_stats[name] - solve_start[name] for name in solve_stats.keys()}
+    stats.update({f'lp_{name}': fn.lp_stats[name] - lp_start[name] for name in fn.lp_stats.keys()})
+    solve_stats.update(solve_start) # the counters of the hours solved in the main process are only added once, from the schedule
+    fn.lp_stats.update(lp_start)
+
+    return rows, stats
+
+def precompute_schedule(schedule_file, inputs_hash, inputs, sensors_data, total_minutes, workers):
+    # the solutions of the equation system only depend on the sensor data and the targets of each hour, so every minute of the run is solved beforehand, one hour per task
+    if Path(schedule_file).exists():
+        with np.load(schedule_file) as saved:
+            if str(saved['inputs_hash']) == inputs_hash and 'stats_names' in saved.files: # schedules saved without their counters are solved again
+                return {name: saved[name] for name in saved.files}
+
+    chunks = [range(first, min(first + 60, total_minutes)) for first in range(0, total_minutes, 60)]
+    chunks_rows = [{sensor_id: np.asarray(sensors_data[sensor_id][chunk.start:chunk.stop], dtype=np.float64) for sensor_id in sensors_data.keys()} for chunk in chunks]
+    workers = min(workers or os.cpu_count(), len(chunks))
+    print(f"Solving the {total_minutes} minutes of the schedule with {workers} worker(s)")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(solve_schedule_minutes, [inputs] * len(chunks), [chunk.start for chunk in chunks], chunks_rows))
+    else:
+        results = [solve_schedule_minutes(inputs, chunk.start, chunk_rows) for chunk, chunk_rows in zip(chunks, chunks_rows)]
+
+    schedule = {name: np.concatenate([np.asarray(rows[name]) for rows, _ in results]) for name in results[0][0].keys()}
+    schedule['stats_names'] = np.array(list(results[0][1].keys()), dtype=np.str_) # counters of the sampling and simplex runs of the whole schedule
+    schedule['stats_values'] = np.array([sum(stats[name] for _, stats in results) for name in results[0][1].keys()], dtype=np.int64)
+    schedule['percentages'] = schedule['percentages'].astype(np.int8)
+    schedule['calibrator_ids'] = np.array(list(inputs['calibrators'].keys()), dtype=np.str_)
+    schedule['router_ids'] = np.array(list(inputs['routers'].keys()), dtype=np.str_)
+    Path(schedule_file).parent.mkdir(parents=True, exist_ok=True)
+    np.savez(schedule_file, inputs_hash=np.array(inputs_hash), **schedule)
+
+    return schedule
+
+# variables of the control loop that are stored with the SUMO state, so that an interrupted run can resume from the last checkpoint
+CHECKPOINT_VARIABLES = ['step', 'current_day', 'current_hour', 'current_min', 'TTS', 'results_buffer', 'results_row', 'flow_speed_min', 'oldVehIDs', 'perm_dists', 'temp_dists', 'sensors', 'variables_values', 'free_variables_target', 'last_free_solution',
+                        'closest_feasible_X_free_relative_error', 'Xcomplete', 'free_variables_order', 'r_dists', 'new_veh_ids', 'sim_time', 'vehIDs_all', 'result_files', 'calib_flows',
+                        'pending_routes', 'assigned_routes', 'active_vehicles', 'route_dists']
+
+def set_calibrator_flow(calib_flows, calib_id, *flow, next_minute=True, **options):
+    calib_flows[calib_id] = (flow, options) # the flows set through TraCI are not part of the saved SUMO state, so they are restored from the checkpoint
+    traci.calibrator.setFlow(calib_id, *flow, **options)
+    if next_minute: # a calibrator stops once its last interval ends, so the next minute is added with the default flow until it is set
+        begin, end, _, _, veh_type, route = flow
+        traci.calibrator.setFlow(calib_id, end, 2 * end - begin, *CALIBRATOR_DEFAULT_FLOW, veh_type, route, **options)
+
+def save_checkpoint(checkpoint_dir, hour, values):
+    Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    fn.saveState(hour, checkpoint_dir)
+    with open(f'{checkpoint_dir}/state_{hour}.pkl', 'wb') as f:
+        pickle.dump({'variables': dict(zip(CHECKPOINT_VARIABLES, values)), 'random_state': np.random.get_state()}, f)
+
+def get_last_checkpoint(checkpoint_dir):
+    hours = [int(file.stem.split('_')[1]) for file in Path(checkpoint_dir).glob('state_*.pkl') if file.with_suffix('.xml').exists()]
+    if not hours:
+        return None
+
+    with open(f'{checkpoint_dir}/state_{max(hours)}.pkl', 'rb') as f:
+        return max(hours), pickle.load(f)
+
+def run_network(config, network_name, network_file, label='default', run_dir=None):
+    # with a `run_dir`, the outputs of the simulation are kept apart from those of other networks running at the same time
+    start_time = time.time()
+    prefix = f'[{network_name}] ' if run_dir else ''
+    traci.use(config.get('params', 'BACKEND', fallback='traci')) # 'libsumo' runs SUMO inside this process
+    solve_stats.update(new_solve_stats()) # the processes of the runner simulate several networks, whose counters are kept apart
+    fn.lp_stats.update(dict.fromkeys(fn.lp_stats, 0))
 
     node_filename = network_file.split('.')[-3].split('/')[-1]
+    profiler.start(config, f"{f'{run_dir}/profiles' if run_dir else config.get('profiler', 'DIR', fallback='./output/profiles')}/profile_{node_filename}", traci)
     network = sumolib.net.readNet(network_file)
 
     entries_exits_file = config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md')
-    network_sensors_file = config.get('nodes', 'SENSORS', fallback='./nodes/network_sensors.md')
-    coverage_file = config.get('sensors', 'COVERAGE', fallback='./sumo/coverage.md')
-
-    sensors_coverage = get_sensors_coverage(coverage_file)
-    node_sensors = {}
-    for sensor_id in get_network_sensors(network_sensors_file)[network_name]:
-        node_sensors[sensor_id] = sensors_coverage[sensor_id][0]
+    artifacts_dir = config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts')
+    sensors_coverage, node_sensors = get_node_sensors(config, network_name)
 
-    entry_nodes, exit_nodes, routers, perm_dists, sensors, oldVehIDs = initialize_variables(network_name, network_file, node_sensors, entries_exits_file)
+    entry_nodes, exit_nodes, routers, perm_dists, sensors, oldVehIDs = initialize_variables(network_name, network_file, node_sensors, entries_exits_file, artifacts_dir)
 
     # TODO: criar ficheiro dos calibrators -> done
-    output_dir = config.get('dir', 'OUTPUT', fallback='./output')
+    output_dir = f'{run_dir}/output' if run_dir else config.get('dir', 'OUTPUT', fallback='./output')
     calibrators_dir = config.get('dir', 'CALIBRATORS', fallback='./sumo/calibrators')
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     Path(calibrators_dir).mkdir(parents=True, exist_ok=True)
     calibrators_file = f'{calibrators_dir}/calib_{node_filename}.add.xml'
-    calib_routes = generate_calibrators(calibrators_file, entry_nodes, routers, network)
+    calib_routes = generate_calibrators(calibrators_file, entry_nodes, routers, network, output_dir)
+    calibrators_mode = config.get('params', 'CALIBRATORS', fallback='runtime') # 'runtime' adds the flow of each minute through TraCI, 'replay' also writes a day of flows from the sensor data to the calibrators file
 
     equations_file = config.get('nodes', 'EQUATIONS', fallback='./nodes/equations.md')
-    eq_variables = get_eq_variables(network_name, equations_file)
     calibrators = get_calibrators(calibrators_file)
-    data_file = config.get('sensors', 'DATA_ARTICLE', fallback='./data/article_data.xlsx') if network_name == 'Article' else config.get('sensors', 'DATA', fallback='./data/sensor_data.xlsx')
+    data_file = config.get('sensors', 'DATA_ARTICLE', fallback='./data/article_data.xlsx') if network_name == 'Article' else config.get('sensors', 'DATA', fallback='./data/sensor_data')
     free_variables_file = config.get('nodes', 'FREE_VARIABLES', fallback='./nodes/free_variables.md')
     intensities_file = config.get('nodes', 'INTENSITIES', fallback='./nodes/intensities.json')
-    free_variables = get_free_variables(free_variables_file)
+    free_variables = {}
+    free_variables[network_name], compiled_expr = load_free_variables(artifacts_dir, free_variables_file, network_name) # only the artifact of the network is read, falling back to the markdown files
+    eq_variables = free_variables[network_name][5] if compiled_expr is not None else get_eq_variables(network_name, equations_file)
+    if config.get('params', 'EXPRESSIONS', fallback='compiled') == 'compiled': # 'sympy' substitutes the sensor values in the expression strings every minute
+        b_con_expr, Xparticular_expr = compiled_expr or (fn.compile_list_expr(free_variables[network_name][2]), fn.compile_x_particular(free_variables[network_name][3]))
+    else:
+        b_con_expr, Xparticular_expr = free_variables[network_name][2], free_variables[network_name][3]
     free_variables_target = {var: 5 for var in free_variables[network_name][0]} # TODO: read the target values of the free variables from the Here API
+    free_variables_order = sorted(list(free_variables_target.keys()), key=lambda x: int(x[1:]))
     sensors_edges = get_sensors_edges(network, sensors)
+    entry_counting_edges, exit_counting_edges, edge_nodes = build_topology_index(network, entry_nodes, exit_nodes, sensors_edges)
     covered_edges = [edges[1] for sensor, edges in sensors_coverage.items() if sensor in node_sensors.keys()]
     covered_calibrators = get_covered_calibrators(calibrators, sensors_edges, covered_edges)
     nodes_dir = config.get('dir', 'NODES', fallback='./nodes')
     with open(f"{nodes_dir}/variables_{node_filename}.pkl", 'rb') as f:
         variables = pickle.load(f)
     variables_values = {} # variable : [flow, speed]
-    entry_exit_variables = get_entry_exit_variables(entry_nodes, exit_nodes, variables)
-    timestamp_hours, sensors_data = get_sensors_data(network_name, sensors, data_file)
+    entry_exit_variables = get_entry_exit_variables(network, entry_nodes, exit_nodes, variables)
+    result_schema = get_result_schema(sensors_edges, entry_exit_variables, sensors_coverage, variables, edge_nodes, free_variables_order, eq_variables)
+    timestamp_hours, sensors_data = get_sensors_data(network_name, sensors, data_file, config.get('sensors', 'CACHE', fallback='')) # an empty `CACHE` reads the workbook on every run
     week_days = get_week_days(timestamp_hours)
+    if calibrators_mode == 'replay':
+        replay_calibrators(calibrators_file, covered_calibrators, sensors_data, int(config.get('params', 'HOURS', fallback='24')) * 60)
     sumo_cmd = prepare_sumo(config, network_name)
-    results_dir = config.get('dir', 'RESULTS', fallback='./sumo/results')
+    results_dir = f'{run_dir}/results' if run_dir else config.get('dir', 'RESULTS', fallback='./sumo/results')
+    output_format = config.get('params', 'OUTPUT_FORMAT', fallback='excel') # 'csv' writes gzip-compressed CSV files, 'parquet' a dataset partitioned by network and day (requires pyarrow)
+    check_results_format(output_format)
     Path(results_dir).mkdir(parents=True, exist_ok=True)
+    result_files = []
     vehIDs_all = []
 
     # TODO: criar ficheiro dos flows iniciais -> done
@@ -385,7 +761,14 @@ if __name__ == '__main__':
     routes_dir = config.get('dir', 'ROUTES', fallback='./sumo/routes')
     Path(routes_dir).mkdir(parents=True, exist_ok=True)
     routes_file = f'{routes_dir}/routes_{node_filename}.xml'
-    generate_routes(routes_file, routers, network)
+    route_distributions = config.get('params', 'ROUTE_DISTRIBUTIONS', fallback='file') # 'file' writes every distribution to the routes file, 'on_demand' creates only the ones used and draws the routes itself
+    if route_distributions == 'on_demand' and config.get('params', 'ROUTING', fallback='indexed') != 'indexed':
+        raise Exception("The on-demand route distributions require the indexed routing")
+    router_routes = generate_routes(routes_file, routers, network, route_distributions == 'file')
+    router_splits = {router: get_split_edges(network.getEdge(routers[router][2])) for router in routers.keys()} # router_id : [edge_ids of the branches of its split]
+
+    if run_dir:
+        sumo_cmd = get_isolated_sumo_cmd(sumo_cmd, network_file, [f"{config.get('dir', 'SUMO', fallback='./sumo')}/vtype_distribution.add.xml", routes_file, flows_file, calibrators_file], f'{run_dir}/sim.log')
 
     # TODO: ler intensidades do tráfego nas edges em questão
     with open(intensities_file, 'r') as int_file:
@@ -394,181 +777,200 @@ if __name__ == '__main__':
     current_day = current_hour = current_min = TTS = 0
     total_hours = int(config.get('params', 'HOURS', fallback='24'))
     time_clean = int(config.get('params', 'TIME_CLEAN', fallback='2400')) # seconds to wait and then remove old vehicles from the permanent distribution lists (routing control)
+    routing = config.get('params', 'ROUTING', fallback='indexed') # 'indexed' routes each vehicle once when it reaches a router, 'legacy' scans the distribution lists every second
     time_sleep = int(config.get('params', 'TIME_SLEEP', fallback='0')) # slow down or speed up the simulation
 
+    counting = config.get('params', 'COUNTING', fallback='subscription') # 'subscription' batches the TraCI requests of the entry/exit counting, 'polling' requests each edge and vehicle individually
     num_simplex_runs = int(config.get('params', 'NUM_SIMPLEX_RUNS', fallback='300'))
+    sampler = config.get('params', 'SAMPLER', fallback='simplex') # 'simplex' runs random simplex objectives, 'vectorized' draws and checks the candidates in batch, 'projection' finds the closest feasible point to the target without random numbers
+    projection_norm = config.get('params', 'PROJECTION_NORM', fallback='l1') # distance minimised by the projection sampler, 'l1' (a mixed-integer program) or 'l2' (a quadratic program)
+    if projection_norm not in ['l1', 'l2']:
+        raise Exception(f"Unknown projection norm '{projection_norm}', choose from ['l1', 'l2']")
+    num_samples = int(config.get('params', 'NUM_SAMPLES', fallback='3000')) # candidates drawn per minute by the vectorized sampler
+    budget = get_control_budget(config) # attempts and seconds of sampling of each minute before falling back
     step_length = float(config.get('params', 'STEP_LENGTH', fallback='0.25')) # seconds each step takes
     total_steps = total_hours * 3600 * (1/step_length)
-
+    steps_per_iteration = int(1/step_length) if counting == 'subscription' else 1 # nothing happens between seconds, so advance a second at once and receive the subscription results only when counting
+
+    checkpoint_hours = int(config.get('params', 'CHECKPOINT_HOURS', fallback='0')) # save the simulation state every given number of hours, 0 disables the checkpoints
+    checkpoint_dir = f'{run_dir}/checkpoints' if run_dir else f"{config.get('dir', 'CHECKPOINTS', fallback='./sumo/checkpoints')}/{node_filename}"
+    checkpoint = get_last_checkpoint(checkpoint_dir) if config.getboolean('params', 'RESUME', fallback=False) else None
+    if checkpoint_hours:
+        sumo_cmd = sumo_cmd + ['--save-state.rng', 'true'] # so that a resumed run draws the same random numbers as an uninterrupted one
+    resumed_step = -1
+
+    schedule = None # arrays of the precomputed minutes, replayed instead of solving the equation system in the control loop
+    if config.get('params', 'CONTROL', fallback='inline') == 'schedule':
+        schedule_file = f"{config.get('dir', 'SCHEDULES', fallback='./sumo/schedules')}/schedule_{node_filename}.npz"
+        schedule_inputs = {'sensors_edges': sensors_edges, 'variables': variables, 'free_variables': free_variables[network_name], 'b_con_expr': b_con_expr, 'Xparticular_expr': Xparticular_expr,
+                           'sampler': sampler, 'num_simplex_runs': num_simplex_runs, 'num_samples': num_samples, 'intensities': intensities[network_name], 'week_days': week_days, 'routers': routers,
+                           'router_splits': router_splits, 'max_branches': max(len(splits) for splits in router_splits.values()), 'eq_variables': eq_variables, 'calibrators': calibrators, 'covered_calibrators': covered_calibrators, 'budget': budget, 'projection_norm': projection_norm}
+        inputs_hash = get_inputs_hash([data_file, intensities_file, free_variables_file, f'{artifacts_dir}/{get_node_filename(network_file)}_system.npz', f'{nodes_dir}/variables_{node_filename}.pkl'], [total_hours, sampler, num_simplex_runs, num_samples, SCHEDULE_SEED, list(calibrators.items()), list(covered_calibrators.items()), budget, projection_norm])
+        schedule = precompute_schedule(schedule_file, inputs_hash, schedule_inputs, sensors_data, total_hours * 60 + 1, int(config.get('params', 'SCHEDULE_WORKERS', fallback='0'))) # the control loop also solves the minute that ends the run
+        for name, value in zip(schedule['stats_names'], schedule['stats_values']): # the minutes were solved by the workers or by an earlier run, so their counters are reported with this one
+            if name.startswith('lp_'):
+                fn.lp_stats[name[len('lp_'):]] += int(value)
+            else:
+                solve_stats[name] += int(value)
+
+    metrics_interval = int(config.get('metrics', 'INTERVAL', fallback='5')) if config.getboolean('metrics', 'ENABLED', fallback=False) else 0 # simulated minutes between the samples of the run metrics
+    if metrics_interval:
+        metrics_dir = f'{run_dir}/metrics' if run_dir else config.get('metrics', 'DIR', fallback='./output/metrics')
+        Path(metrics_dir).mkdir(parents=True, exist_ok=True)
+        metrics_file = f'{metrics_dir}/metrics_{node_filename}'
+        if checkpoint is None: # a resumed run continues the samples of the interrupted one
+            open(f'{metrics_file}.jsonl', 'w').close()
+
+    # all the hours run in a single SUMO session, the hourly results being written without interrupting the simulation
+    last_free_solution = None
+    calib_flows = {} # calibrator_id : (flow, options) of the current minute
+    pending_routes = {router: {} for router in routers.keys()} # router_id : {vehID : route_distribution_name}
+    assigned_routes = {router: set() for router in routers.keys()} # router_id : {vehIDs}
+    temp_dists, sim_time = {}, 0 # bookkeeping of the legacy routing
+    active_vehicles = set() # vehIDs in the network, updated with the departed and arrived vehicles of each step
+    route_dists = {} # route_distribution_name : ([route_ids], probabilities) of the distributions created at runtime
     while current_hour < total_hours:
-        print(f"Running simulation for hour {current_hour + 1} of {total_hours}")
-        traci.start(sumo_cmd)
+        print(f"{prefix}Running simulation for hour {current_hour + 1} of {total_hours}")
+        with profiler.phase('start'):
+            traci.start(sumo_cmd, label=label)
 
-        controlFile = np.zeros((1, len(oldVehIDs) * 2 + 1)) # controlFile -> guarda os resultados periodicamente? -> o segundo número é o dobro de entradas e saídas, mais 1 para o TTS
+        results_buffer, results_row = new_results_buffer(result_schema), 0 # the results of the current hour, one row per minute
         flow_speed_min = reset_flow_speed_min(entry_nodes, exit_nodes)
 
-        # if current_hour > 0:
-        #     fn.loadState(current_hour - 1)
-        #         time.sleep(0.05)
-
         step = 0
+        if checkpoint: # continue an interrupted run from its last checkpoint
+            hour, saved = checkpoint
+            fn.loadState(hour, checkpoint_dir, sumo_cmd[1:])
+            step, current_day, current_hour, current_min, TTS, results_buffer, results_row, flow_speed_min, oldVehIDs, perm_dists, temp_dists, sensors, variables_values, free_variables_target, last_free_solution, \
+                closest_feasible_X_free_relative_error, Xcomplete, free_variables_order, r_dists, new_veh_ids, sim_time, vehIDs_all, result_files, calib_flows, \
+                pending_routes, assigned_routes, active_vehicles, route_dists = [saved['variables'][name] for name in CHECKPOINT_VARIABLES]
+            np.random.set_state(saved['random_state'])
+            for calib_id, (flow, options) in calib_flows.items():
+                set_calibrator_flow(calib_flows, calib_id, *flow, next_minute=calibrators_mode == 'runtime', **options)
+            print(f"{prefix}Resuming the simulation from the checkpoint of hour {hour}")
+            resumed_step, checkpoint = step, None
+        metrics_state = new_metrics_state(step)
+
+        if counting == 'subscription':
+            fn.subscribeCountingEdges(list(entry_counting_edges.values()) + list(exit_counting_edges.values()))
+        if routing == 'indexed' and counting == 'subscription':
+            fn.subscribeRouting([routers[router][2] for router in routers.keys()])
+        fn.subscribeLifecycle()
+
         while step <= total_steps:
-            traci.simulationStep()
+            if checkpoint_hours and step > 0 and step % (3600 * checkpoint_hours * (1/step_length)) == 0 and step != resumed_step: # before the hour is written, so that resuming repeats this iteration
+                with profiler.phase('checkpoint'):
+                    save_checkpoint(checkpoint_dir, int(step * step_length) // 3600, [step, current_day, current_hour, current_min, TTS, results_buffer, results_row, flow_speed_min, oldVehIDs, perm_dists, temp_dists, sensors, variables_values, free_variables_target, last_free_solution,
+                                                                                  closest_feasible_X_free_relative_error, Xcomplete, free_variables_order, r_dists, new_veh_ids, sim_time, vehIDs_all, result_files, calib_flows,
+                                                                                  pending_routes, assigned_routes, active_vehicles, route_dists])
+
+            with profiler.phase('step'):
+                traci.simulationStep((step + 1) * step_length) if steps_per_iteration > 1 else traci.simulationStep()
+                departed_ids, arrived_ids = fn.getLifecycleEvents()
+                fn.trackVehicles(active_vehicles, oldVehIDs, departed_ids, arrived_ids)
+                if routing == 'indexed':
+                    fn.evictArrivedVehicles(pending_routes, assigned_routes, arrived_ids)
 
             if step % (1/step_length) == 0: # a second has passed
-                # TODO: update the flow in variables for each entry on the network -> done
-                new_veh_ids = {} # node : [vehIDs]
+                with profiler.phase('counting'):
+                    # TODO: update the flow in variables for each entry on the network -> done
+                    new_veh_ids = {} # node : [vehIDs]
+                    counting_results = fn.getCountingResults() if counting == 'subscription' else ()
 
-                for node in entry_nodes:
-                    start_edge, next_edge = get_counting_edges(network.getNode(node).getOutgoing()[0], sensors_edges)
-                    flow, speed, oldVehIDs[node], new_veh_ids[node] = fn.edgeVehParameters(start_edge.getID(), next_edge.getID(), oldVehIDs[node])
-                    flow_speed_min[node] = (flow_speed_min[node][0], flow_speed_min[node][1] + flow, flow_speed_min[node][2] + speed) # TODO: somar speed porquê?
+                    for node, (start_edge, next_edge) in entry_counting_edges.items():
+                        flow, speed, oldVehIDs[node], new_veh_ids[node] = fn.edgeVehParameters(start_edge, next_edge, oldVehIDs[node], *counting_results)
+                        flow_speed_min[node] = (flow_speed_min[node][0], flow_speed_min[node][1] + flow, flow_speed_min[node][2] + speed) # TODO: somar speed porquê?
 
-                # TODO: update the flow out variables for each exit on the network -> done
-                for node in exit_nodes:
-                    start_edge, next_edge = get_counting_edges_exits(network.getNode(node).getIncoming()[0], sensors_edges) # select edges with sensors closest to the exits
-                    flow, speed, oldVehIDs[node], _ = fn.edgeVehParameters(start_edge.getID(), next_edge.getID(), oldVehIDs[node])
-                    flow_speed_min[node] = (flow_speed_min[node][0], flow_speed_min[node][1] + flow, flow_speed_min[node][2] + speed) # TODO: somar speed porquê?
+                    # TODO: update the flow out variables for each exit on the network -> done
+                    for node, (start_edge, next_edge) in exit_counting_edges.items():
+                        flow, speed, oldVehIDs[node], _ = fn.edgeVehParameters(start_edge, next_edge, oldVehIDs[node], *counting_results)
+                        flow_speed_min[node] = (flow_speed_min[node][0], flow_speed_min[node][1] + flow, flow_speed_min[node][2] + speed) # TODO: somar speed porquê?
 
             if step % (60 * (1/step_length)) == 0: # a minute has passed
                 # TODO: # store locally (in pandas dataframe) simulation data recorded during the last minute
-                if step > 0:
-                    # TODO: for each of the entries/exits with sensors (qX - constants), get the total flow (cars + trucks) -> done
-                    # TODO: for each of the entries/exits with sensors (qX - constants), get the speed (cars + trucks) -> done
+                with profiler.phase('record'):
+                    if step > 0:
+                        # TODO: for each of the entries/exits with sensors (qX - constants), get the total flow (cars + trucks) -> done
+                        # TODO: for each of the entries/exits with sensors (qX - constants), get the speed (cars + trucks) -> done
+                        for edge_id in sensors_edges.keys():
+                            variables_values[variables[edge_id]['root_var']] = [0, 0]
+                            speed_list = []
+                            for sensor_id in sensors_edges[edge_id]:
+                                variables_values[variables[edge_id]['root_var']][0] += sensors[sensor_id][1][0] + sensors[sensor_id][1][2] # update the flow of the variable
+                                speed_list.extend([sensors[sensor_id][1][1], sensors[sensor_id][1][3]])
+
+                            x = 0.001 + sum(s > 0 for s in speed_list)
+                            variables_values[variables[edge_id]['root_var']][1] = sum(speed_list) / x # update the speed of the variable
+
+                        # TODO: record the main entries/exits (real/simulated values), then rounded TTS, then the remaining entries/exits -> done
+                        results_buffer, results_row = record_minute(results_buffer, results_row, result_schema, variables_values, flow_speed_min, TTS, closest_feasible_X_free_relative_error, Xcomplete)
+
+                        # TODO: reset values of the flows and speedSums of the minute to zero -> done
+                        flow_speed_min = reset_flow_speed_min(entry_nodes, exit_nodes)
+
+                with profiler.phase('control'):
+                    # TODO: fill the vectors of each detector (array of size 4) with the values read from the real data -> done
+                    for sensor_id in sensors.keys():
+                        for i in range(4):
+                            sensors[sensor_id][1][i] = sensors_data[sensor_id][current_min][i]
+
+                    # TODO: for each of the main entries/exits (qX - constants I guess), get the total flow (cars + trucks) -> repeated with the first line after the step>0 condition - maybe move up -> done
                     for edge_id in sensors_edges.keys():
                         variables_values[variables[edge_id]['root_var']] = [0, 0]
-                        speed_list = []
                         for sensor_id in sensors_edges[edge_id]:
                             variables_values[variables[edge_id]['root_var']][0] += sensors[sensor_id][1][0] + sensors[sensor_id][1][2] # update the flow of the variable
-                            speed_list.extend([sensors[sensor_id][1][1], sensors[sensor_id][1][3]])
-
-                        x = 0.001 + sum(s > 0 for s in speed_list)
-                        variables_values[variables[edge_id]['root_var']][1] = sum(speed_list) / x # update the speed of the variable
-
-                    # TODO: np.vstack of "controlFile" variable (25 values), first the main entries/exits (real/simulated values), then rounded TTS, then the remaining entries/exits -> done
-                    controlFile_list = []
-                    for edge_id in sorted(sensors_edges.keys()): # save the flow values of the sensor edges
-                        node = get_node(network, flow_speed_min, edge_id)
-                        controlFile_list.extend([variables_values[variables[edge_id]['root_var']][0], flow_speed_min[node][1] * 60])
-                    
-                    controlFile_list.append(round(TTS)) # TODO: understand what TTS means and how it is updated
-
-                    for edge_id in sorted(entry_exit_variables.keys()): # save the flow values of the remaining entry and exit edges
-                        if not any(edge_id in lst[1] for lst in sensors_coverage.values()):
-                            node = get_node(network, flow_speed_min, edge_id)
-                            if variables[edge_id]['root_var'] in free_variables_order:
-                                var_index = free_variables_order.index(variables[edge_id]['root_var'])
-                                controlFile_list.extend([closest_feasible_X_free_relative_error[var_index], flow_speed_min[node][1] * 60])
-                            else:
-                                var_index = eq_variables.index(variables[edge_id]['root_var'])
-                                controlFile_list.extend([Xcomplete[var_index][0], flow_speed_min[node][1] * 60])
-                    
-                    controlFile = np.vstack([controlFile, controlFile_list])
-
-                    # TODO: reset values of the flows and speedSums of the minute to zero -> done
-                    flow_speed_min = reset_flow_speed_min(entry_nodes, exit_nodes)
-
-                # TODO: fill the vectors of each detector (array of size 4) with the values read from the real data -> done
-                for sensor_id in sensors.keys():
-                    for i in range(4):
-                        sensors[sensor_id][1][i] = sensors_data[sensor_id][current_min][i]
-
-                # TODO: for each of the main entries/exits (qX - constants I guess), get the total flow (cars + trucks) -> repeated with the first line after the step>0 condition - maybe move up -> done
-                for edge_id in sensors_edges.keys():
-                    variables_values[variables[edge_id]['root_var']] = [0, 0]
-                    for sensor_id in sensors_edges[edge_id]:
-                        variables_values[variables[edge_id]['root_var']][0] += sensors[sensor_id][1][0] + sensors[sensor_id][1][2] # update the flow of the variable
-
-                # TODO: define the intensity levels of the free variables based on the current hour of the day -> done
-                for var in free_variables[network_name][0]:
-                    week_day = week_days[current_day]
-                    free_variables_target[var] = intensities[network_name][week_day][var][current_hour % 24]
-
-                # TODO: apply the Simplex algorithm
-                while True:
-                    # TODO: calculate the closest feasible error, that gives the values for the free variables -> done
-                    Xnull = free_variables[network_name][4]
-                    free_variables_order = sorted(list(free_variables_target.keys()), key=lambda x: int(x[1:]))
-                    closest_feasible_X_free_relative_error, targets, Xparticular = fn.restrictedFreeVarRange(variables_values, free_variables_order, free_variables_target, free_variables[network_name][1], free_variables[network_name][2], free_variables[network_name][3], Xnull, num_simplex_runs)
-
-                    # TODO: calculate the solution for the entire equation system (Xcomplete), by defining the matrices Xparticular and Xnull -> done
-                    Xnull_cols = []
-                    for i in range(len(free_variables_target)):
-                        Xnull_cols.append(np.array([[row[i]] for row in Xnull]))
-
-                    Xcomplete = Xparticular.astype(np.float64)
-                    for i in range(len(free_variables_target)):
-                        Xcomplete += closest_feasible_X_free_relative_error[i] * Xnull_cols[i]
-
-                    # TODO: if all variables are positive, break the loop (solution found?) -> done
-                    if np.all(Xcomplete >= 0):
-                        break
+
+                    # TODO: define the intensity levels of the free variables based on the current hour of the day -> done
+                    for var in free_variables[network_name][0]:
+                        week_day = week_days[current_day]
+                        free_variables_target[var] = intensities[network_name][week_day][var][current_hour % 24]
+
+                    # TODO: apply the Simplex algorithm
+                    with profiler.phase('control.sampling'):
+                        free_variables_order = sorted(list(free_variables_target.keys()), key=lambda x: int(x[1:]))
+                        if schedule is not None: # solved beforehand by `precompute_schedule`
+                            closest_feasible_X_free_relative_error, Xcomplete = schedule['free'][current_min], schedule['Xcomplete'][current_min]
+                        else:
+                            closest_feasible_X_free_relative_error, Xcomplete = solve_minute(variables_values, free_variables_target, free_variables_order, free_variables[network_name], b_con_expr, Xparticular_expr, sampler, num_simplex_runs, num_samples, last_free_solution, budget, projection_norm)
+                            last_free_solution = closest_feasible_X_free_relative_error # warm start of the next minute
                 
-                # TODO: update TTS -> done
-                TTS += (traci.vehicle.getIDCount()) * (60 / 3600)
-
-                # TODO: generate (calibrate) traffic flows - set flows of the calibrators in the entries of the network (for cars and trucks)
-                for calib_id in calibrators.keys():
-                    if calib_id in covered_calibrators.keys():
-                        if '_car_' in calib_id:
-                            flow_idx, speed_idx, veh_type = 0, 1, 'vtype_car'
-                        elif '_truck_' in calib_id:
-                            flow_idx, speed_idx, veh_type = 2, 3, 'vtype_truck'
-                        
-                        v_calib = [sensors[sensor_id][1][speed_idx] / 3.6 for sensor_id in covered_calibrators[calib_id]]
-                        x = 0.001 + sum(x > 0 for x in v_calib)
-                        vehsPerHour = 0
-                        for sensor_id in covered_calibrators[calib_id]:
-                            vehsPerHour += sensors[sensor_id][1][flow_idx]
-                        speed = sum(v_calib) / x
-                        traci.calibrator.setFlow(calib_id, step * step_length, (step * step_length) + 60, vehsPerHour, speed, veh_type, calib_routes[calib_id], departLane='free', departSpeed='max')
-                    else:
-                        if variables[calibrators[calib_id]]['root_var'] in free_variables_order:
-                            var_index = free_variables_order.index(variables[calibrators[calib_id]]['root_var'])
-                            if '_car_' in calib_id:
-                                traci.calibrator.setFlow(calib_id, step * step_length, (step * step_length) + 60, closest_feasible_X_free_relative_error[var_index], 22.22, 'vtype_car', calib_routes[calib_id], departLane='free', departSpeed='max')
-                            elif '_truck_' in calib_id: # TODO: porquê que mete o fluxo a zero para trucks?
-                                traci.calibrator.setFlow(calib_id, step * step_length, (step * step_length) + 60, 0, 22.22, 'vtype_truck', calib_routes[calib_id], departLane='free', departSpeed='max')
+                    # TODO: update TTS -> done
+                    TTS += (traci.vehicle.getIDCount()) * (60 / 3600)
+
+                    # TODO: generate (calibrate) traffic flows - set flows of the calibrators in the entries of the network (for cars and trucks)
+                    with profiler.phase('control.calibrators'):
+                        if schedule is not None:
+                            setpoints = {calib_id: (*schedule['calibrators'][current_min][i], get_calibrator_vtype(calib_id)) for i, calib_id in enumerate(schedule['calibrator_ids'])}
                         else:
-                            var_index = free_variables[network_name][5].index(variables[calibrators[calib_id]]['root_var'])
-
-                            if '_car_' in calib_id:
-                                traci.calibrator.setFlow(calib_id, step * step_length, (step * step_length) + 60, Xcomplete[var_index], 22.22, 'vtype_car', calib_routes[calib_id], departLane='free', departSpeed='max')
-                            elif '_truck_' in calib_id: # TODO: porquê que mete o fluxo a zero para trucks?
-                                traci.calibrator.setFlow(calib_id, step * step_length, (step * step_length) + 60, 0, 22.22, 'vtype_truck', calib_routes[calib_id], departLane='free', departSpeed='max')
-
-                current_min += 1
-
-                # TODO: for each SUMO router, calculate the route distribution probabilities on its bifurcations
-                prob_dists = {} # router_id : {edge_id : prob_dist}
-                for router in routers.keys():
-                    var = variables[routers[router][2]]['root_var']
-                    if var.startswith('q'):
-                        var_value = variables_values[var][0]
-                    elif var.startswith('x'):
-                        var_value = float(Xcomplete[eq_variables.index(var)][0])
-
-                    prob_dists[router] = {}
-                    if var_value != 0:
-                        splitting_edge = get_splitting_edge(network.getEdge(routers[router][2]))
-                        split_edges = list(splitting_edge.getOutgoing().keys())
-                        if len(split_edges) != 2: # TODO: como lidar com casos em que a edge se divide em mais do que duas?
-                            raise Exception(f"Router {router} in split with more than 2 outgoing edges. Please adapt the network so that each split has only 2 outgoing edges.")
-                        
-                        var_index_1 = eq_variables.index(variables[split_edges[0].getID()]['root_var'])
-                        prob_dists[router][split_edges[0].getID()] = int((np.round(10 * (Xcomplete[var_index_1]) / var_value)) * 10)
-                        prob_dists[router][split_edges[1].getID()] = int(100 - prob_dists[router][split_edges[0].getID()])
-                    else:
-                        prob_dists[router][split_edges[0].getID()] = 50
-                        prob_dists[router][split_edges[1].getID()] = 50
+                            setpoints = get_calibrator_setpoints(calibrators, covered_calibrators, {sensor_id: sensors[sensor_id][1] for sensor_id in sensors.keys()}, variables, free_variables_order, free_variables[network_name][5], closest_feasible_X_free_relative_error, Xcomplete)
+                        for calib_id, (vehsPerHour, speed, veh_type) in setpoints.items():
+                            set_calibrator_flow(calib_flows, calib_id, step * step_length, (step * step_length) + 60, vehsPerHour, speed, veh_type, calib_routes[calib_id], next_minute=calibrators_mode == 'runtime', departLane='free', departSpeed='max')
+
+                    current_min += 1
+
+                    # TODO: for each SUMO router, calculate the route distribution probabilities on its bifurcations
+                    with profiler.phase('control.routes'):
+                        if schedule is not None:
+                            prob_dists = {router: dict(zip(router_splits[router], (int(percentage) for percentage in schedule['percentages'][current_min - 1][i]))) for i, router in enumerate(schedule['router_ids'])}
+                        else:
+                            prob_dists = get_router_percentages(routers, router_splits, variables, variables_values, eq_variables, Xcomplete)
 
-                # TODO: averiguar se a ordem de escrita dos valores prob não varia
-                r_dists = {} # router_id : route_distribution_name
-                for router in routers.keys():
-                    first_prob, second_prob = prob_dists[router].values()
-                    r_dists[router] = f'routedist_{routers[router][2]}_{first_prob}_{second_prob}'
+                        # TODO: averiguar se a ordem de escrita dos valores prob não varia
+                        r_dists = {} # router_id : route_distribution_name
+                        for router in routers.keys():
+                            r_dists[router] = get_route_distribution_id(routers[router][2], prob_dists[router].values())
+                            if route_distributions == 'on_demand' and r_dists[router] not in route_dists:
+                                route_dists[r_dists[router]] = get_route_distribution(router_routes, routers[router][2], list(prob_dists[router].values()))
+
+            if step % (1/step_length) == 0 and routing == 'indexed':
+                with profiler.phase('routing'):
+                    fn.registerVehicleRoutes(pending_routes, assigned_routes, [vehID for veh_list in new_veh_ids.values() for vehID in veh_list], r_dists)
+                    if step > 0:
+                        edge_vehicles = counting_results[0] if counting == 'subscription' else None
+                        for router in routers.keys():
+                            fn.routingIndexed(routers[router][2], pending_routes[router], assigned_routes[router], edge_vehicles, route_dists if route_distributions == 'on_demand' else None)
 
-            if step % (1/step_length) == 0: # write results of the second?
+            elif step % (1/step_length) == 0: # write results of the second?
                 if step % (60 * (1/step_length)) == 0: # is this condition really needed?
                     # TODO: add flags/markers to vehicles with routes assigned
                     sim_time = round(traci.simulation.getTime())
@@ -599,51 +1001,52 @@ if __name__ == '__main__':
                             temp_dists[router][0][0].append(veh_id)
 
                 # TODO: DFC mechanism
-                if step > 0:
-                    if sim_time % time_clean == 0:
-                        # TODO: get the ID list of all vehicles currently running within the scenario -> done
-                        vehIDs_all = traci.vehicle.getIDList()
+                with profiler.phase('routing'):
+                    if step > 0:
+                        if sim_time % time_clean == 0:
+                            # TODO: get the ID list of all vehicles currently running within the scenario -> done
+                            vehIDs_all = active_vehicles
 
-                    # TODO: for each distribution, dinamically assign routes to the vehicles according to the probability distribution model -> done
-                    for router in routers.keys():
-                        edgeStartPlusOne = routers[router][2] # TODO: qual a edgeStart a enviar? Para já envio a edge do router
-                        # incoming_edges = network.getEdge(edgeStartPlusOne).getFromNode().getIncoming()
-                        # if len(incoming_edges) != 1:
-                        #     raise Exception(f"Router {router}'s edge {edgeStartPlusOne} has more than one incoming edge. Please adapt the network so that it has only one incoming edge.")
-                        temp_dists[router], perm_dists[router] = fn.routingDinamically(edgeStartPlusOne, temp_dists[router], perm_dists[router], edgeStartPlusOne, time_clean, sim_time, vehIDs_all)
+                        # TODO: for each distribution, dinamically assign routes to the vehicles according to the probability distribution model -> done
+                        for router in routers.keys():
+                            edgeStartPlusOne = routers[router][2] # TODO: qual a edgeStart a enviar? Para já envio a edge do router
+                            # incoming_edges = network.getEdge(edgeStartPlusOne).getFromNode().getIncoming()
+                            # if len(incoming_edges) != 1:
+                            #     raise Exception(f"Router {router}'s edge {edgeStartPlusOne} has more than one incoming edge. Please adapt the network so that it has only one incoming edge.")
+                            temp_dists[router], perm_dists[router] = fn.routingDinamically(edgeStartPlusOne, temp_dists[router], perm_dists[router], edgeStartPlusOne, time_clean, sim_time, vehIDs_all)
 
-                    vehIDs_all = []
+                        vehIDs_all = []
 
             # TODO: slow down or speed up the simulation based on the predefined value -> done
-            time.sleep(time_sleep)
+            time.sleep(time_sleep * steps_per_iteration)
 
             if step % (3600 * (1/step_length)) == 0 and step > 0: # an hour has passed
-                # TODO: store the "controlFile" content in an Excel file
-                df_content = {}
-                index = 0
-                for edge_id in sorted(sensors_edges.keys()):
-                    df_content[f'f_{edge_id}_ref'] = controlFile[1:, index]
-                    df_content[f'f_{edge_id}'] = controlFile[1:, index + 1]
-                    index += 2
-                df_content['TTS'] = controlFile[1:, index]
-                index += 1
-                for edge_id in sorted(entry_exit_variables.keys()):
-                    if not any(edge_id in lst[1] for lst in sensors_coverage.values()):
-                        df_content[f'f_{edge_id}_ref'] = controlFile[1:, index]
-                        df_content[f'f_{edge_id}'] = controlFile[1:, index + 1]
-                        index += 2
-
-                df = pd.DataFrame(df_content)
-
-                # fn.saveState(current_hour)  # one can save simulation state e.g., each hour (simulation can be thus reloaded and simulated from this point in time)
+                # TODO: store the results of the hour in an Excel file -> done
                 TTS = 0
                 save_data_time = timestamp_hours[current_hour][0] # TODO: era current_hour - 1, mas não parece fazer sentido, vai buscar o último timestamp
-                df.to_excel(f'{results_dir}/flow_{save_data_time}.xlsx', index=False)
-                controlFile = np.zeros((1, len(oldVehIDs) * 2 + 1))
+                with profiler.phase('results'):
+                    result_files.append(flush_results(results_buffer, results_row, get_results_file(results_dir, network_name, save_data_time, output_format)))
+                results_row = 0
                 current_hour += 1
+                print(f"{prefix}Hour {current_hour} of {total_hours} written to {result_files[-1]}")
+                profiler.end_hour(current_hour, prefix)
                 if current_hour % 24 == 0:
                     current_day = current_hour // 24
 
-            step += 1
+            if metrics_interval and step > 0 and step % (60 * metrics_interval * (1/step_length)) == 0:
+                write_metrics(metrics_file, collect_metrics(metrics_state, network_name, step, step_length, current_hour, active_vehicles, perm_dists, pending_routes, assigned_routes, fn.lp_stats, solve_stats))
 
-        traci.close()
\ No newline at end of file
+            step += steps_per_iteration
+
+        traci.close()
+
+    profiler.stop(prefix)
+    if solve_stats['exhausted']:
+        print(f"{prefix}{solve_stats['exhausted']} of {solve_stats['minutes']} minutes exhausted the control budget, fallbacks used: " + ', '.join(f"{key[len('fallback_'):]} {count}" for key, count in solve_stats.items() if key.startswith('fallback_') and count))
+    return {'network': network_name, 'hours': current_hour, 'result_files': result_files, 'elapsed': time.time() - start_time}
+
+if __name__ == '__main__':
+    config = load_config()
+    network_name, network_file = config.get('nodes', 'NODE_ARTICLE', fallback='./nodes/no_artigo.net.xml').split(',') # TODO: set the node that we want to analyse in the Makefile
+    # network_name, network_file = config.get('nodes', 'NODE_COIMBROES', fallback='./nodes/no_coimbroes.net.xml').split(',') # TODO: set the node that we want to analyse in the Makefile
+    run_network(config, network_name, network_file)
\ No newline at end of file
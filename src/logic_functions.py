@@ -1,32 +1,101 @@
-import traci
 import numpy as np
+import traci.constants as tc
 from sympy import sympify
-from scipy.optimize import linprog
+from itertools import product
+from scipy.optimize import linprog, milp, minimize, LinearConstraint, Bounds
 
-def edgeVehParameters(start_edge, next_edge, oldVehIDs): # TODO: não fazer distinção entre entry e exit nodes?
+from .backend import traci
+
+lp_stats = {'success': 0, 'failure': 0, 'milp_success': 0, 'milp_failure': 0, 'qp_success': 0, 'qp_failure': 0} # cumulative outcome of the simplex runs, and of the mixed-integer and quadratic programs of the projection
+MAX_ROUNDING_VARIABLES = 10 # free variables up to which every floor/ceil neighbour of the continuous L2 projection is checked for the first incumbent, beyond that it is only rounded
+INTEGER_TOLERANCE = 1e-6 # distance to the closest integer under which a value of a quadratic program is taken as integer
+
+def runSimplex(c, **kwargs):
+    res = linprog(c, **kwargs)
+    lp_stats['success' if res.success else 'failure'] += 1
+
+    return res
+
+def runMilp(c, A_ub, b_ub, integrality):
+    # the variables are non-negative, as with the default bounds of `linprog`
+    res = milp(c, constraints=LinearConstraint(A_ub, -np.inf, b_ub), integrality=integrality, bounds=Bounds(0, np.inf))
+    lp_stats['milp_success' if res.success else 'milp_failure'] += 1
+
+    return res
+
+def runQp(point, G, h, lower, upper):
+    # continuous L2 projection of `point` onto the points with `G x <= h` within the bounds
+    res = minimize(lambda x: np.sum((x - point) ** 2), np.clip(point, lower, upper), jac=lambda x: 2 * (x - point), method='SLSQP', bounds=Bounds(lower, upper),
+                   constraints=[{'type': 'ineq', 'fun': lambda x: h - G @ x, 'jac': lambda x: -G}])
+    lp_stats['qp_success' if res.success else 'qp_failure'] += 1
+
+    return res
+
+def subscribeCountingEdges(counting_edges):
+    # subscribe to the vehicles on the counting edges, and to the speeds of the vehicles on the start edges, so that a single batch per step replaces the per-edge and per-vehicle requests
+    for start_edge, next_edge in counting_edges:
+        traci.edge.subscribe(start_edge, [tc.LAST_STEP_VEHICLE_ID_LIST])
+        traci.edge.subscribe(next_edge, [tc.LAST_STEP_VEHICLE_ID_LIST])
+        traci.edge.subscribeContext(start_edge, tc.CMD_GET_VEHICLE_VARIABLE, 0, [tc.VAR_SPEED])
+
+def getCountingResults():
+    edge_vehicles = traci.edge.getAllSubscriptionResults() # edge_id : {LAST_STEP_VEHICLE_ID_LIST : vehIDs}
+    edge_speeds = traci.edge.getAllContextSubscriptionResults() # edge_id : {vehID : {VAR_SPEED : speed}}
+
+    return edge_vehicles, edge_speeds
+
+def getEdgeVehicleIDs(edge_id, edge_vehicles):
+    if edge_vehicles is None:
+        return traci.edge.getLastStepVehicleIDs(edge_id)
+    return edge_vehicles.get(edge_id, {}).get(tc.LAST_STEP_VEHICLE_ID_LIST, ())
+
+def getVehicleSpeed(vehID, edge_id, edge_speeds):
+    if edge_speeds is not None and vehID in edge_speeds.get(edge_id, {}):
+        return edge_speeds[edge_id][vehID][tc.VAR_SPEED]
+    return traci.vehicle.getSpeed(vehID) # vehicles outside the context range of the edge shape are requested individually
+
+def edgeVehParameters(start_edge, next_edge, oldVehIDs, edge_vehicles=None, edge_speeds=None): # TODO: não fazer distinção entre entry e exit nodes?
     # for small time step should capture only one veh on detector with the length of 5 [m]
-    intersection = set(oldVehIDs).intersection(traci.edge.getLastStepVehicleIDs(next_edge))
+    oldVehIDs.difference_update(getEdgeVehicleIDs(next_edge, edge_vehicles))
 
-    if len(list(intersection)) != 0:
-        for idVeh in list(intersection):
-            indexVeh = oldVehIDs.index(idVeh)
-            del oldVehIDs[indexVeh]
-    
-    currentVehIDs = traci.edge.getLastStepVehicleIDs(start_edge)
-    newVehIDs = []
-    for vehID in currentVehIDs:
-        if vehID not in oldVehIDs:
-            newVehIDs.append(vehID)
+    newVehIDs = [vehID for vehID in getEdgeVehicleIDs(start_edge, edge_vehicles) if vehID not in oldVehIDs]
     
     flow = speed = 0
     for vehID in newVehIDs:
-        speed += traci.vehicle.getSpeed(vehID)
-        oldVehIDs.append(vehID)
+        speed += getVehicleSpeed(vehID, start_edge, edge_speeds)
+        oldVehIDs.add(vehID)
         flow += 1
         
     return flow, speed, oldVehIDs, newVehIDs
 
+def compile_list_expr(list_expr):
+    # the expressions are fixed linear forms over the sensor variables, so they are parsed once into a coefficient matrix (the last column holds the constant terms)
+    symbols = sorted({str(symbol) for expr in list_expr for symbol in sympify(expr).free_symbols}, key=lambda x: int(x[1:]))
+    coefficients = np.zeros((len(list_expr), len(symbols) + 1), dtype=np.int64)
+    for i, expr in enumerate(list_expr):
+        for term, coefficient in sympify(expr).as_coefficients_dict().items():
+            if term.is_number:
+                coefficients[i, -1] += int(term * coefficient)
+            elif term.is_Symbol:
+                coefficients[i, symbols.index(str(term))] = int(coefficient)
+            else:
+                raise Exception(f"The expression {expr} is not linear on the sensor variables")
+
+    return symbols, coefficients
+
+def compile_x_particular(Xparticular_expr):
+    return compile_list_expr([row[0] for row in Xparticular_expr])
+
+def calc_compiled_expr(compiled_expr, variables_values):
+    symbols, coefficients = compiled_expr
+    values = np.array([variables_values[symbol][0] for symbol in symbols] + [1], dtype=np.float64)
+
+    return np.trunc(coefficients @ values).astype(np.int64)
+
 def calc_list_expr(b_con_expr, variables_values):
+    if isinstance(b_con_expr, tuple): # compiled by `compile_list_expr`
+        return calc_compiled_expr(b_con_expr, variables_values)
+
     b_con = []
     for i in range(len(b_con_expr)):
         if b_con_expr[i] in variables_values:
@@ -41,6 +110,9 @@ def calc_list_expr(b_con_expr, variables_values):
     return b_con
 
 def calc_x_particular(Xparticular_expr, variables_values):
+    if isinstance(Xparticular_expr, tuple): # compiled by `compile_x_particular`
+        return calc_compiled_expr(Xparticular_expr, variables_values).reshape(-1, 1)
+
     Xparticular = []
     for i in range(len(Xparticular_expr)):
         Xparticular.append(calc_list_expr(Xparticular_expr[i], variables_values))
@@ -63,7 +135,7 @@ def freeVarRange(free_variables_target, A_con, b_con, Xparticular, Xnull, num_si
 
     for i in range(num_simplex_runs):
         c = np.array([np.random.uniform(-1,1) for _ in range(len(free_variables_target))])
-        res = linprog(c, A_ub=A_con, b_ub=b_con)
+        res = runSimplex(c, A_ub=A_con, b_ub=b_con)
 
         if res.success == True:
             new_x = (np.round(res.x)).reshape(len(free_variables_target), 1)
@@ -113,7 +185,7 @@ def restrictedFreeVarRange(variables_values, free_variables_order, free_variable
             vars_bounds.append((np.floor(vars_bin[var][i_vars[i]]), np.floor(vars_bin[var][i_vars[i]] + d_vars[var])))
 
         c = np.array([np.random.uniform(-1,1) for _ in range(len(free_variables_target))])
-        res = linprog(c, A_ub=A_con, b_ub=b_con, bounds=vars_bounds)
+        res = runSimplex(c, A_ub=A_con, b_ub=b_con, bounds=vars_bounds)
 
         if res.success == True:
             new_x = (np.round(res.x)).reshape(len(free_variables_target), 1)
@@ -150,6 +222,150 @@ def restrictedFreeVarRange(variables_values, free_variables_order, free_variable
 
     return closest_feasible_X_free_relative_error, targets, Xparticular
 
+def freeVarBounds(free_variables_target, A_con, b_con, Xparticular, Xnull):
+    # minimise and maximise each free variable, yielding the vertices that span the feasible bounding box with at most 2·n simplex runs
+    vertices = []
+    for i in range(len(free_variables_target)):
+        for direction in (1, -1):
+            c = np.zeros(len(free_variables_target))
+            c[i] = direction
+            res = runSimplex(c, A_ub=A_con, b_ub=b_con)
+
+            if res.success == True:
+                new_x = (np.round(res.x)).reshape(len(free_variables_target), 1)
+                Xcomplete = calc_x_complete(free_variables_target, Xparticular, Xnull, new_x)
+                if np.all(Xcomplete >= 0):
+                    vertices.append(new_x)
+
+    return np.hstack(vertices) if vertices else np.zeros((len(free_variables_target), 1))
+
+def feasibleFreeVariables(candidates, A_con, b_con, Xparticular, Xnull):
+    # the columns of `candidates` within the constraints whose complete solution is non-negative
+    return np.all(A_con @ candidates <= np.reshape(b_con, (-1, 1)), axis=0) & np.all(candidates >= 0, axis=0) & np.all(np.reshape(Xparticular, (-1, 1)) + Xnull @ candidates >= 0, axis=0)
+
+def closestIntegerPoint(point, G, h, root, A_con, b_con, Xparticular, Xnull):
+    # exact L2 projection onto the integer points, from the continuous projection `root`
+    num_free_variables = len(point)
+
+    # the closest feasible floor/ceil neighbour of the continuous projection is the first incumbent, pruning most of the tree
+    if num_free_variables <= MAX_ROUNDING_VARIABLES:
+        neighbours = np.array(list(product(*[(np.floor(value), np.ceil(value)) for value in root.x]))).T
+    else:
+        neighbours = np.round(root.x).reshape(-1, 1)
+    neighbours = neighbours[:, feasibleFreeVariables(neighbours, A_con, b_con, Xparticular, Xnull)]
+    distances = np.sum((neighbours - point[:, None]) ** 2, axis=0)
+    best, best_distance = (neighbours[:, distances.argmin()], distances.min()) if neighbours.shape[1] else (None, np.inf)
+
+    # each branch bounds a fractional free variable below its floor or above its ceiling, and is pruned when its continuous projection is not closer than the incumbent
+    branches = [(np.zeros(num_free_variables), np.full(num_free_variables, np.inf), root)]
+    while branches:
+        lower, upper, res = branches.pop()
+        if not res.success or res.fun >= best_distance - INTEGER_TOLERANCE:
+            continue
+
+        fractional = np.abs(res.x - np.round(res.x))
+        if fractional.max() <= INTEGER_TOLERANCE:
+            candidate = np.round(res.x)
+            if feasibleFreeVariables(candidate.reshape(-1, 1), A_con, b_con, Xparticular, Xnull)[0]:
+                best, best_distance = candidate, np.sum((candidate - point) ** 2)
+            continue
+
+        i = fractional.argmax()
+        below_upper, above_lower = upper.copy(), lower.copy()
+        below_upper[i], above_lower[i] = np.floor(res.x[i]), np.ceil(res.x[i])
+        children = [(lower, below_upper), (above_lower, upper)]
+        if res.x[i] - np.floor(res.x[i]) < 0.5: # the branch closer to the point is explored first
+            children.reverse()
+        branches.extend((child_lower, child_upper, runQp(point, G, h, child_lower, child_upper)) for child_lower, child_upper in children)
+
+    return best if best is not None else root.x # no feasible integer point, so the continuous one is kept
+
+def projectFreeVariables(point, A_con, b_con, Xparticular, Xnull, norm='l1'):
+    # closest integer point to `point` within the constraints whose complete solution is non-negative, returning None when there is no feasible point
+    # 'l1' is a single mixed-integer program over the free variables and their distances to the point, 'l2' a branch and bound over quadratic programs
+    num_free_variables = len(np.ravel(point))
+    point = np.ravel(point).astype(np.float64)
+    A_con, Xnull = np.array(A_con, dtype=np.float64), np.array(Xnull, dtype=np.float64)
+    G, h = np.vstack([A_con, -Xnull]), np.concatenate([np.ravel(b_con), np.ravel(Xparticular)]) # G x <= h
+
+    if norm == 'l2':
+        root = runQp(point, G, h, np.zeros(num_free_variables), np.full(num_free_variables, np.inf))
+        if root.success:
+            return closestIntegerPoint(point, G, h, root, A_con, b_con, Xparticular, Xnull)
+        # the L1 projection is kept when the quadratic program fails
+
+    identity = np.eye(num_free_variables)
+    c = np.concatenate([np.zeros(num_free_variables), np.ones(num_free_variables)])
+    A_ub = np.vstack([np.hstack([identity, -identity]), np.hstack([-identity, -identity]), np.hstack([G, np.zeros((len(G), num_free_variables))])])
+    b_ub = np.concatenate([point, -point, h])
+    res = runMilp(c, A_ub, b_ub, np.concatenate([np.ones(num_free_variables), np.zeros(num_free_variables)]))
+    if res.success:
+        return np.round(res.x[:num_free_variables])
+
+    res = runSimplex(c, A_ub=A_ub, b_ub=b_ub) # no feasible integer point, so the continuous one is kept
+    return res.x[:num_free_variables] if res.success == True else None
+
+def projectedFreeVarRange(variables_values, free_variables_order, free_variables_target, A_con, b_con_expr, Xparticular_expr, Xnull, norm='l1'):
+    # alternative to `restrictedFreeVarRange` and `vectorizedFreeVarRange`, with the same bins and targets but without random numbers
+    # instead of drawing feasible points and keeping the closest one, the target is projected onto the feasible set, so every run gives the same solution
+    A_con = np.array(A_con)
+    b_con = np.array(calc_list_expr(b_con_expr, variables_values))
+    Xparticular = np.array(calc_x_particular(Xparticular_expr, variables_values))
+
+    X_free_range = freeVarBounds(free_variables_target, A_con, b_con, Xparticular, Xnull)
+    a0_vars = np.nanmin(X_free_range, axis=1)
+    d_vars = (np.nanmax(X_free_range, axis=1) - a0_vars) / 9
+    vars_bin = np.floor(a0_vars[:, None] + d_vars[:, None] * np.arange(10)) # free variable x bin
+
+    targets = {}
+    for i, var in enumerate(free_variables_order):
+        targets[var] = vars_bin[i][free_variables_target[var]]
+
+    target_vec = np.array([targets[var] for var in free_variables_order])
+    closest_feasible_X_free_relative_error = projectFreeVariables(target_vec, A_con, b_con, Xparticular, Xnull, norm)
+    if closest_feasible_X_free_relative_error is None: # as the other samplers when they find no feasible point
+        closest_feasible_X_free_relative_error = np.zeros(len(free_variables_order))
+
+    return closest_feasible_X_free_relative_error, targets, Xparticular
+
+def vectorizedFreeVarRange(variables_values, free_variables_order, free_variables_target, A_con, b_con_expr, Xparticular_expr, Xnull, num_samples, warm_start=None):
+    # alternative to `restrictedFreeVarRange`, with the same bins, targets and selection of the closest feasible point
+    # the random simplex runs are replaced by integer candidates drawn in batch within random bins, whose feasibility is checked with a single matrix product
+    # the vertices of the bounding box and the previous solution (warm start) are also candidates, so a feasible point is found whenever the bounding box is
+    A_con = np.array(A_con)
+    b_con = np.array(calc_list_expr(b_con_expr, variables_values))
+    Xparticular = np.array(calc_x_particular(Xparticular_expr, variables_values))
+    num_free_variables = len(free_variables_order)
+
+    X_free_range = freeVarBounds(free_variables_target, A_con, b_con, Xparticular, Xnull)
+    a0_vars = np.nanmin(X_free_range, axis=1)
+    d_vars = (np.nanmax(X_free_range, axis=1) - a0_vars) / 9
+    vars_bin = a0_vars[:, None] + d_vars[:, None] * np.arange(10) # free variable x bin
+
+    i_vars = np.random.randint(0, 10, size=(num_free_variables, num_samples))
+    lower_bounds = np.floor(np.take_along_axis(vars_bin, i_vars, axis=1))
+    upper_bounds = np.floor(np.take_along_axis(vars_bin, i_vars, axis=1) + d_vars[:, None])
+    candidates = lower_bounds + np.floor(np.random.uniform(size=lower_bounds.shape) * (upper_bounds - lower_bounds + 1))
+    candidates = np.hstack([candidates, X_free_range] + ([np.reshape(warm_start, (num_free_variables, 1))] if warm_start is not None else []))
+
+    feasible = feasibleFreeVariables(candidates, A_con, b_con, Xparticular, np.array(Xnull))
+    X_free_bound_feasible = candidates[:, feasible] if np.any(feasible) else np.zeros((num_free_variables, 1))
+
+    vars_bin = np.floor(vars_bin)
+    targets = {}
+    for i, var in enumerate(free_variables_order):
+        targets[var] = vars_bin[i][free_variables_target[var]]
+
+    target_vec = np.array([[targets[var]] for var in free_variables_order])
+    norm_target = np.linalg.norm(target_vec, axis=0)
+    norm_diff_target_feasible_array = np.linalg.norm(X_free_bound_feasible - target_vec, axis=0)
+    relative_error = norm_diff_target_feasible_array / norm_target
+
+    relative_error_index = relative_error.argmin()
+    closest_feasible_X_free_relative_error = X_free_bound_feasible[:, relative_error_index]
+
+    return closest_feasible_X_free_relative_error, targets, Xparticular
+
 def routingDinamically(edgeStart, temp_obj_dist, perm_obj_dist, edgeStart_id, time_clean, sim_time, vehIDs_all):
     currentVehIDs = traci.edge.getLastStepVehicleIDs(edgeStart)
 
@@ -196,8 +412,55 @@ def routingDinamically(edgeStart, temp_obj_dist, perm_obj_dist, edgeStart_id, ti
 
     return temp_obj_dist, perm_obj_dist
 
-def saveState(current_hour):
-    traci.simulation.saveState(f'state_{str(current_hour)}.xml')
+def subscribeRouting(router_edges):
+    # subscribe to the vehicles on the router edges
+    for edge in router_edges:
+        traci.edge.subscribe(edge, [tc.LAST_STEP_VEHICLE_ID_LIST])
+
+def subscribeLifecycle():
+    # subscribe to the vehicles that entered and left the network, accumulated over the steps of a `simulationStep` call
+    traci.simulation.subscribe([tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS])
+
+def getLifecycleEvents():
+    results = traci.simulation.getSubscriptionResults()
+    return results.get(tc.VAR_DEPARTED_VEHICLES_IDS, ()), results.get(tc.VAR_ARRIVED_VEHICLES_IDS, ())
+
+def trackVehicles(active_vehicles, oldVehIDs, departedIDs, arrivedIDs):
+    # the vehicles are only tracked while they are in the network, including those counted at an entry or exit whose next edge was not sampled
+    active_vehicles.update(departedIDs)
+    active_vehicles.difference_update(arrivedIDs)
+    for vehIDs in oldVehIDs.values():
+        vehIDs.difference_update(arrivedIDs)
+
+def registerVehicleRoutes(pending_routes, assigned_routes, vehIDs, r_dists):
+    # the new vehicles wait at every router for the route distribution of the minute they entered the network
+    for router, pending in pending_routes.items():
+        for vehID in vehIDs:
+            if vehID not in assigned_routes[router]:
+                pending[vehID] = r_dists[router]
+
+def routingIndexed(edgeStart, pending, assigned, edge_vehicles=None, route_dists=None):
+    # only the vehicles on the router edge are looked up, and each one is routed once
+    for vehID in getEdgeVehicleIDs(edgeStart, edge_vehicles):
+        route_dist = pending.pop(vehID, None)
+        if route_dist is not None:
+            if route_dists is None: # SUMO draws the route from the distribution of the routes file
+                traci.vehicle.setRouteID(vehID, route_dist)
+            else:
+                route_ids, probabilities = route_dists[route_dist]
+                traci.vehicle.setRouteID(vehID, route_ids[np.random.choice(len(route_ids), p=probabilities)])
+            assigned.add(vehID)
+
+def evictArrivedVehicles(pending_routes, assigned_routes, arrivedIDs):
+    # the vehicles that never reached a router, or already passed it, are forgotten when they leave the network
+    for router, pending in pending_routes.items():
+        for vehID in arrivedIDs:
+            pending.pop(vehID, None)
+            assigned_routes[router].discard(vehID)
+
+def saveState(current_hour, state_dir='.'):
+    traci.simulation.saveState(f'{state_dir}/state_{str(current_hour)}.xml')
     
-def loadState(current_hour):
-    traci.load(['--start', '1', '--quit-on-end', '1', '--load-state', f'state_{str(current_hour)}.xml'])
\ No newline at end of file
+def loadState(current_hour, state_dir='.', sumo_args=('--start', '1', '--quit-on-end', '1')):
+    # `traci.load` replaces all the options of the running simulation, so the ones of the original command must be given again
+    traci.load(list(sumo_args) + ['--load-state', f'{state_dir}/state_{str(current_hour)}.xml'])
\ No newline at end of file
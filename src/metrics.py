@@ -0,0 +1,100 @@
+"""Run Metrics
+
+This module writes the progress of a digital twin run while it is going, according to the `[metrics]` section of the `config.ini` file.
+Every `INTERVAL` simulated minutes, a sample is appended to a JSONL file and the Prometheus textfile of the network is replaced, so that it can be scraped by the textfile collector of the node exporter.
+
+"""
+
+import os
+import json
+import time
+from datetime import datetime
+
+def get_rss_bytes():
+    # resident memory of this process, read from /proc (Linux only)
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def new_metrics_state(step=0):
+    # the wall time and step of the last sample, from which the rates of the next one are measured
+    return {'wall': time.perf_counter(), 'step': step}
+
+def collect_metrics(state, network_name, step, step_length, current_hour, active_vehicles, perm_dists, pending_routes, assigned_routes, lp_stats, solve_stats):
+    wall, simulated = time.perf_counter(), (step - state['step']) * step_length
+    elapsed = max(wall - state['wall'], 1e-9)
+    state.update(wall=wall, step=step)
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'network': network_name,
+        'simulated_seconds': step * step_length,
+        'hour': current_hour,
+        'sim_wall_ratio': simulated / elapsed, # simulated seconds per wall-clock second since the last sample
+        'steps_per_second': simulated / step_length / elapsed,
+        'vehicles': len(active_vehicles),
+        'perm_dists': {router: len(dists) for router, dists in perm_dists.items()}, # entries of the permanent distributions of the legacy routing
+        'pending_routes': sum(len(pending) for pending in pending_routes.values()), # vehicles waiting for a route in the indexed routing
+        'assigned_routes': sum(len(assigned) for assigned in assigned_routes.values()),
+        'lp_success': lp_stats['success'], # simplex runs
+        'lp_failure': lp_stats['failure'],
+        'milp_success': lp_stats['milp_success'], # mixed-integer and quadratic programs of the projection sampler and fallback
+        'milp_failure': lp_stats['milp_failure'],
+        'qp_success': lp_stats['qp_success'],
+        'qp_failure': lp_stats['qp_failure'],
+        'sampled_minutes': solve_stats['minutes'],
+        'sampling_retries': solve_stats['retries'], # repetitions of the sampling of a minute whose solution had negative values
+        'control_exhausted': solve_stats['exhausted'], # minutes whose control budget was exhausted
+        'control_fallbacks': {key[len('fallback_'):]: count for key, count in solve_stats.items() if key.startswith('fallback_')},
+        'rss_bytes': get_rss_bytes(),
+    }
+
+# name : (type, help, key of the sample)
+PROMETHEUS_METRICS = {
+    'simulated_seconds': ('gauge', 'Simulated time of the run.', 'simulated_seconds'),
+    'sim_wall_ratio': ('gauge', 'Simulated seconds per wall-clock second since the last sample.', 'sim_wall_ratio'),
+    'steps_per_second': ('gauge', 'Simulation steps per wall-clock second since the last sample.', 'steps_per_second'),
+    'vehicles': ('gauge', 'Vehicles in the network.', 'vehicles'),
+    'pending_routes': ('gauge', 'Vehicles waiting for a route.', 'pending_routes'),
+    'assigned_routes': ('gauge', 'Vehicles with an assigned route still in the network.', 'assigned_routes'),
+    'sampled_minutes_total': ('counter', 'Minutes whose equation system was sampled.', 'sampled_minutes'),
+    'sampling_retries_total': ('counter', 'Repetitions of the sampling of a minute.', 'sampling_retries'),
+    'control_exhausted_total': ('counter', 'Minutes whose control budget was exhausted.', 'control_exhausted'),
+    'rss_bytes': ('gauge', 'Resident memory of the process.', 'rss_bytes'),
+}
+
+# kind of solver : help
+SOLVER_METRICS = {
+    'lp': 'Simplex runs by outcome.',
+    'milp': 'Mixed-integer programs of the projection by outcome.',
+    'qp': 'Quadratic programs of the L2 projection by outcome.',
+}
+
+def get_prometheus_text(metrics):
+    network = metrics['network'].replace('\\', '\\\\').replace('"', '\\"')
+    lines = []
+    for name, (metric_type, help_text, key) in PROMETHEUS_METRICS.items():
+        if metrics[key] is None:
+            continue
+        lines.extend([f'# HELP digital_twin_{name} {help_text}', f'# TYPE digital_twin_{name} {metric_type}', f'digital_twin_{name}{{network="{network}"}} {metrics[key]}'])
+
+    for kind, help_text in SOLVER_METRICS.items():
+        lines.extend([f'# HELP digital_twin_{kind}_runs_total {help_text}', f'# TYPE digital_twin_{kind}_runs_total counter'])
+        lines.extend(f'digital_twin_{kind}_runs_total{{network="{network}",outcome="{outcome}"}} {metrics[f"{kind}_{outcome}"]}' for outcome in ['success', 'failure'])
+    lines.extend(['# HELP digital_twin_control_fallbacks_total Minutes solved by each fallback of the control budget.', '# TYPE digital_twin_control_fallbacks_total counter'])
+    lines.extend(f'digital_twin_control_fallbacks_total{{network="{network}",fallback="{fallback}"}} {count}' for fallback, count in metrics['control_fallbacks'].items())
+    lines.extend(['# HELP digital_twin_perm_dists_size Entries of the permanent distribution of each router.', '# TYPE digital_twin_perm_dists_size gauge'])
+    lines.extend(f'digital_twin_perm_dists_size{{network="{network}",router="{router}"}} {size}' for router, size in metrics['perm_dists'].items())
+
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(metrics_file, metrics):
+    # `metrics_file` is the path of the outputs without extension, the samples being appended to the .jsonl file and the last one replacing the .prom file
+    with open(f'{metrics_file}.jsonl', 'a') as f:
+        f.write(json.dumps(metrics) + '\n')
+
+    with open(f'{metrics_file}.prom.tmp', 'w') as f:
+        f.write(get_prometheus_text(metrics))
+    os.replace(f'{metrics_file}.prom.tmp', f'{metrics_file}.prom') # the collector never reads a partially written file
@@ -3,19 +3,21 @@
 This script reads the location of the detectors from a spreadsheet and derives the corresponding network coverage of the sensors.
 It also creates the calibrator objects in the network entries, generating the corresponding files in the `sumo/calibrators` folder.
 It prepares the simulation view, editing the file `vci.view.xml` in the `sumo` folder according to the parameters in the `config.ini` file.
-It also prepares sensor data, grouping counts into 1-minute blocks.
+It also prepares sensor data, grouping counts into 1-minute blocks, with the sensor folders processed in parallel and written as binary sheets (optionally exported to a workbook).
 
 """
 
+import io
+import os
 import sumolib
 import operator
-import xlsxwriter
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import xml.etree.cElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 
-from .utils import load_config, remove_chars, write_xml
+from .utils import load_config, remove_chars, write_xml, save_artifact, save_sheet, load_sheets, get_node_filename, get_inputs_hash, load_manifest, save_manifest, get_cached_outputs, set_cached_outputs
 
 def convert_coords_to_SUMO(network, coords):
     coords = remove_chars(coords, '()')
@@ -47,7 +49,7 @@ def get_closest_lane(network, x, y, radius):
     else:
         raise Exception()
     
-def gen_entry_exit_nodes(network_name, nodes, eef):
+def gen_entry_exit_nodes(network_name, network_file, nodes, eef, artifacts_dir):
     entry_nodes = []
     exit_nodes = []
 
@@ -71,6 +73,7 @@ def gen_entry_exit_nodes(network_name, nodes, eef):
     eef.write(f'### Entry and exit nodes of {network_name}:\n')
     eef.write(f'Entry nodes: {[entry.getID() for entry in entry_nodes]}\n')
     eef.write(f'Exit nodes: {[exit.getID() for exit in exit_nodes]}\n\n')
+    save_artifact(artifacts_dir, network_name, network_file, 'nodes', entry_nodes=np.array([entry.getID() for entry in entry_nodes], dtype=np.str_), exit_nodes=np.array([exit.getID() for exit in exit_nodes], dtype=np.str_))
 
 def gen_coverage(df, network, network_article):
     radius = 50
@@ -124,143 +127,173 @@ def prepare_view():
     delay_elem.set('value', config.get('params', 'DELAY', fallback='20'))
     write_xml(root, view_file)
 
-def prepare_data():
-    data_dir = config.get('dir', 'DATA', fallback='./data')
-    data_file = f'{data_dir}/sensor_data.xlsx'
-    workbook = xlsxwriter.Workbook(data_file)
-    timestamp_sheet = workbook.add_worksheet('timestamp')
-    days = np.empty(shape=(0,))
-
-    # define the formats
-    format = {'align': 'vcenter', 'valign': 'center'}
-    base_format = workbook.add_format(format)
-    format.update({'bold': True, 'border': 1, 'bottom': 1, 'right': 1})
-    header_format = workbook.add_format(format)
-
-    print(f"\n::: Starting processing sensor data :::\n")
-    for file in Path(data_dir).iterdir():
-        if file.is_dir():
-            sensor = file.name
-            worksheet_name = sensor if len(sensor) <= 31 else sensor[:31] # max sheet name length is 31
-            if sensor == 'CAV401-2;CAV401-1' or sensor == 'AEDL - A1 297+975 CT3687' or sensor == 'AEDL - A1 300+250 CT3688':
-                sensor_sheet_c = workbook.add_worksheet(f'{worksheet_name}_C')
-                sensor_sheet_d = workbook.add_worksheet(f'{worksheet_name}_D')
-            else:
-                sensor_sheet = workbook.add_worksheet(worksheet_name)
-
-            print(f"Processing data from the sensor {sensor}...")
-
-            columns = ['carFlows', 'carSpeeds', 'truckFlows', 'truckSpeeds']
-            result = pd.DataFrame(columns=columns)
-            timestamp_days = np.array([])
-            for data_sheet in file.iterdir():
-                if data_sheet.is_file() and data_sheet.suffix == '.xlsx':
-                    worksheets = pd.ExcelFile(data_sheet).sheet_names
-                    for sheet_name in worksheets:
-                        if sheet_name.startswith('Traffic'):
-                            df = pd.read_excel(data_sheet, sheet_name=sheet_name)
-
-                            df['Timestamp'] = pd.to_datetime(df['Timestamp'])
-                            timestamp_days = np.append(timestamp_days, df['Timestamp'].dt.strftime('%Y-%m-%d').unique())
-
-                            df['vehicle_type'] = df['classe_ep'].map({'A': 'car', 'B': 'car', 'C': 'truck', 'D': 'truck'}) if 'classe_ep' in df.columns else df['VehicleTypeId'].map({3: 'car', 4: 'car', 5: 'truck', 6: 'truck'}) # TODO: verify if the car and truck classes are correctly mapped
-                            df.set_index('Timestamp', inplace=True)
-
-                            count_id_col = 'trans_id' if 'trans_id' in df.columns else 'MedidasCCVDetailId'
-                            speed_col = 'speed' if 'speed' in df.columns else 'Velocidade'
-
-                            if sensor == 'CAV401-2;CAV401-1' or sensor == 'AEDL - A1 297+975 CT3687' or sensor == 'AEDL - A1 300+250 CT3688':
-                                # Separate the data into two dataframes based on direction
-                                if sensor == 'CAV401-2;CAV401-1':
-                                    df_direction_c = df[(df['SensorCCVId'] == 76) | (df['SensorCCVId'] == 77) | (df['SensorCCVId'] == 78)]
-                                    df_direction_d = df[(df['SensorCCVId'] == 73) | (df['SensorCCVId'] == 74) | (df['SensorCCVId'] == 75)]
-                                if sensor == 'AEDL - A1 297+975 CT3687' or sensor == 'AEDL - A1 300+250 CT3688':
-                                    df_direction_c = df[df['lane_direction'] == 'C']
-                                    df_direction_d = df[df['lane_direction'] == 'D']
-
-                                # Group and calculate for direction C
-                                grouped_c = df_direction_c.groupby(['vehicle_type', pd.Grouper(freq='1T')])
-
-                                result_sheet_c = pd.DataFrame({
-                                    'carFlows': grouped_c[count_id_col].count()['car'] * 60,
-                                    'carSpeeds': grouped_c[speed_col].mean()['car'] * 60,
-                                    'truckFlows': grouped_c[count_id_col].count()['truck'] * 60,
-                                    'truckSpeeds': grouped_c[speed_col].mean()['truck'] * 60
-                                })
-
-                                # Group and calculate for direction D
-                                grouped_d = df_direction_d.groupby(['vehicle_type', pd.Grouper(freq='1T')])
-
-                                result_sheet_d = pd.DataFrame({
-                                    'carFlows': grouped_d[count_id_col].count()['car'] * 60,
-                                    'carSpeeds': grouped_d[speed_col].mean()['car'] * 60,
-                                    'truckFlows': grouped_d[count_id_col].count()['truck'] * 60,
-                                    'truckSpeeds': grouped_d[speed_col].mean()['truck'] * 60
-                                })
-
-                                # Combine the results into separate dataframes
-                                result_c = result_sheet_c.fillna(0)
-                                result_d = result_sheet_d.fillna(0)
-
-                            grouped = df.groupby(['vehicle_type', pd.Grouper(freq='1T')])
-
-                            result_sheet = pd.DataFrame({
-                                'carFlows': grouped[count_id_col].count()['car'],
-                                'carSpeeds': grouped[speed_col].mean()['car'],
-                                'truckFlows': grouped[count_id_col].count()['truck'],
-                                'truckSpeeds': grouped[speed_col].mean()['truck']
-                            })
-                            result = pd.concat([result, result_sheet], ignore_index=True)
-                            result = result.fillna(0)
-
-            if days.size == 0:
-                days = timestamp_days
-            elif not np.array_equal(days, timestamp_days):
-                print(f"Inconsistent timestamps in folder {sensor}!")
-
-            # create the sensor worksheet
-            if sensor == 'CAV401-2;CAV401-1' or sensor == 'AEDL - A1 297+975 CT3687' or sensor == 'AEDL - A1 300+250 CT3688':
-                sensor_sheet_c.set_column('A:D', 15)
-                sensor_sheet_d.set_column('A:D', 15)
-                for title_cell, title_name, value_cell in [('A1', 'carFlows', 'A2'), ('B1', 'carSpeeds', 'B2'), ('C1', 'truckFlows', 'C2'), ('D1', 'truckSpeeds', 'D2')]:
-                    sensor_sheet_c.write(title_cell, title_name, header_format)
-                    sensor_sheet_d.write(title_cell, title_name, header_format)
-                    sensor_sheet_c.write_column(value_cell, result_c[title_name], base_format)
-                    sensor_sheet_d.write_column(value_cell, result_d[title_name], base_format)
-            else:
-                sensor_sheet.set_column('A:D', 15)
-                for title_cell, title_name, value_cell in [('A1', 'carFlows', 'A2'), ('B1', 'carSpeeds', 'B2'), ('C1', 'truckFlows', 'C2'), ('D1', 'truckSpeeds', 'D2')]:
-                    sensor_sheet.write(title_cell, title_name, header_format)
-                    sensor_sheet.write_column(value_cell, result[title_name], base_format)
-
-    # create the timestamp worksheet
-    timestamp_sheet.set_column('A:A', 15)
-    timestamp_sheet.write('A1', 'timestamp', header_format)
-    cell_number = 2
-    for day in days:
-        for hour in range(24):
-            timestamp_sheet.write(f'A{cell_number}', f'{day}-{hour:02d}-00', base_format)
-            cell_number += 1
-
-    workbook.close()
+SPLIT_SENSORS = { # sensor : (column, values of direction C, values of direction D) of the sensors whose data holds both directions
+    'CAV401-2;CAV401-1': ('SensorCCVId', [76, 77, 78], [73, 74, 75]),
+    'AEDL - A1 297+975 CT3687': ('lane_direction', ['C'], ['D']),
+    'AEDL - A1 300+250 CT3688': ('lane_direction', ['C'], ['D']),
+}
+SENSOR_COLUMNS = ['carFlows', 'carSpeeds', 'truckFlows', 'truckSpeeds']
+
+def aggregate_sheet(df, count_id_col, speed_col):
+    # counts and speed sums per minute and vehicle type, which can be added across sheets before the means are taken
+    columns = pd.MultiIndex.from_product([['count', 'speed_sum', 'speed_count'], ['car', 'truck']])
+    if df['vehicle_type'].isna().all(): # e.g. a direction without data in this sheet
+        return pd.DataFrame(columns=columns, dtype=np.float64)
+
+    grouped = df.groupby(['vehicle_type', pd.Grouper(freq='1min')])
+    aggregates = pd.DataFrame({'count': grouped[count_id_col].count(), 'speed_sum': grouped[speed_col].sum(), 'speed_count': grouped[speed_col].count()})
+
+    return aggregates.unstack('vehicle_type').reindex(columns=columns, fill_value=0).fillna(0)
+
+def get_sensor_values(aggregates, scale):
+    # (minutes x 4) array of the minutes with traffic, in the order of the `SENSOR_COLUMNS`
+    values = np.zeros((len(aggregates), len(SENSOR_COLUMNS)))
+    for i, vehicle_type in enumerate(['car', 'truck']):
+        speed_count = aggregates[('speed_count', vehicle_type)].to_numpy()
+        values[:, 2 * i] = aggregates[('count', vehicle_type)].to_numpy() * scale
+        values[:, 2 * i + 1] = np.divide(aggregates[('speed_sum', vehicle_type)].to_numpy(), speed_count, out=np.zeros(len(aggregates)), where=speed_count > 0) * scale
+
+    return values
+
+def prepare_sensor(sensor_dir, output_dir):
+    sensor = Path(sensor_dir).name
+    worksheet_name = sensor if len(sensor) <= 31 else sensor[:31] # max sheet name length is 31, the same names are used for the binary sheets
+    split = SPLIT_SENSORS.get(sensor)
+    sheet_names = [f'{worksheet_name}_C', f'{worksheet_name}_D'] if split else [worksheet_name]
+    aggregates = {sheet_name: None for sheet_name in sheet_names} # sheet_name : aggregates of the sheets read so far
+    days = set()
+
+    for data_sheet in sorted(Path(sensor_dir).iterdir()):
+        if data_sheet.is_file() and data_sheet.suffix == '.xlsx':
+            with pd.ExcelFile(data_sheet) as workbook:
+                for sheet_name in workbook.sheet_names:
+                    if not sheet_name.startswith('Traffic'):
+                        continue
+                    df = pd.read_excel(workbook, sheet_name=sheet_name)
+
+                    df['Timestamp'] = pd.to_datetime(df['Timestamp'])
+                    days.update(df['Timestamp'].dt.strftime('%Y-%m-%d').unique())
+
+                    df['vehicle_type'] = df['classe_ep'].map({'A': 'car', 'B': 'car', 'C': 'truck', 'D': 'truck'}) if 'classe_ep' in df.columns else df['VehicleTypeId'].map({3: 'car', 4: 'car', 5: 'truck', 6: 'truck'}) # TODO: verify if the car and truck classes are correctly mapped
+                    df.set_index('Timestamp', inplace=True)
+
+                    count_id_col = 'trans_id' if 'trans_id' in df.columns else 'MedidasCCVDetailId'
+                    speed_col = 'speed' if 'speed' in df.columns else 'Velocidade'
+
+                    if split: # separate the data of the two directions
+                        column, values_c, values_d = split
+                        parts = {sheet_names[0]: df[df[column].isin(values_c)], sheet_names[1]: df[df[column].isin(values_d)]}
+                    else:
+                        parts = {sheet_names[0]: df}
+
+                    for output_sheet, part in parts.items():
+                        sheet_aggregates = aggregate_sheet(part, count_id_col, speed_col)
+                        aggregates[output_sheet] = sheet_aggregates if aggregates[output_sheet] is None else aggregates[output_sheet].add(sheet_aggregates, fill_value=0)
+
+    for sheet_name, sheet_aggregates in aggregates.items():
+        values = get_sensor_values(sheet_aggregates.sort_index(), 60 if split else 1) if sheet_aggregates is not None else np.zeros((0, len(SENSOR_COLUMNS))) # the values of the two-direction sensors keep the factor of 60 of the original aggregation
+        save_sheet(output_dir, sheet_name, values)
+
+    return sensor, sorted(days), sheet_names
+
+def export_sensor_data(data_file, output_dir, sheet_names):
+    # optional export of the binary sheets to a workbook, with the layout of the previous `sensor_data.xlsx`
+    with pd.ExcelWriter(data_file, engine='xlsxwriter') as writer:
+        for sheet_name, values in load_sheets(output_dir, sheet_names).items():
+            pd.DataFrame(values, columns=['timestamp'] if sheet_name == 'timestamp' else SENSOR_COLUMNS).to_excel(writer, sheet_name=sheet_name, index=False)
+            writer.sheets[sheet_name].set_column('A:D', 15)
+
+def prepare_data(data_dir, output_dir, workers=0, data_file=None, manifest_file=None):
+    # the sensor folders are aggregated in parallel, each worker writing the binary sheets of its sensor
+    sensor_dirs = sorted(file for file in Path(data_dir).iterdir() if file.is_dir() and any(data_sheet.suffix == '.xlsx' for data_sheet in file.iterdir())) # the binary sheets and caches are not sensor exports
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    # with a manifest, the sensor folders whose files did not change keep their binary sheets
+    manifest = load_manifest(manifest_file) if manifest_file else None
+    results, inputs_hashes, pending = {}, {}, [] # sensor_dir : (sensor, days, sheet_names)
+    for sensor_dir in sensor_dirs:
+        inputs_hashes[sensor_dir.name] = get_inputs_hash([sensor_dir])
+        cached = get_cached_outputs(manifest, 'sensors', sensor_dir.name, inputs_hashes[sensor_dir.name]) if manifest is not None else None
+        if cached is not None and all((Path(output_dir) / f'{sheet_name}.npy').exists() for sheet_name in cached['sheet_names']):
+            results[sensor_dir] = (sensor_dir.name, cached['days'], cached['sheet_names'])
+        else:
+            pending.append(sensor_dir)
+    workers = min(workers or os.cpu_count(), max(len(pending), 1))
+
+    print(f"\n::: Starting processing sensor data ({len(pending)} of {len(sensor_dirs)} sensors changed, {workers} worker(s)) :::\n")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results.update(zip(pending, executor.map(prepare_sensor, pending, [output_dir] * len(pending))))
+    else:
+        results.update((sensor_dir, prepare_sensor(sensor_dir, output_dir)) for sensor_dir in pending)
+    if manifest is not None:
+        for sensor_dir in pending:
+            _, sensor_days, sensor_sheet_names = results[sensor_dir]
+            set_cached_outputs(manifest, 'sensors', sensor_dir.name, inputs_hashes[sensor_dir.name], {'days': sensor_days, 'sheet_names': sensor_sheet_names})
+        save_manifest(manifest_file, manifest, 'sensors', inputs_hashes)
+
+    days, sheet_names = None, ['timestamp']
+    for sensor_dir in sensor_dirs:
+        sensor, sensor_days, sensor_sheet_names = results[sensor_dir]
+        print(f"{'Processed' if sensor_dir in pending else 'Reused'} data from the sensor {sensor}")
+        if days is None:
+            days = sensor_days
+        elif days != sensor_days:
+            print(f"Inconsistent timestamps in folder {sensor}!")
+        sheet_names.extend(sensor_sheet_names)
+
+    save_sheet(output_dir, 'timestamp', np.array([[f'{day}-{hour:02d}-00'] for day in days or [] for hour in range(24)], dtype=np.str_).reshape(-1, 1))
+    if data_file:
+        export_sensor_data(data_file, output_dir, sheet_names)
+
+    return sheet_names
 
 
 if __name__ == '__main__':
     config = load_config()
-    df = pd.read_excel(config.get('sensors', 'LOCATIONS', fallback='./data/sensor_locations.xlsx'))
     # network = sumolib.net.readNet(config.get('sumo', 'NETWORK', fallback='./sumo/vci.net.xml'))
-    network_article = sumolib.net.readNet(config.get('nodes', 'NODE_ARTICLE', fallback='Article,./nodes/no_artigo.net.xml').split(',')[1])
-    network_coimbroes = sumolib.net.readNet(config.get('nodes', 'NODE_COIMBROES', fallback='Nó de Coimbroes,./nodes/no_coimbroes.net.xml').split(',')[1])
+    network_article_file = config.get('nodes', 'NODE_ARTICLE', fallback='Article,./nodes/no_artigo.net.xml').split(',')[1]
+    network_coimbroes_file = config.get('nodes', 'NODE_COIMBROES', fallback='Nó de Coimbroes,./nodes/no_coimbroes.net.xml').split(',')[1]
     entries_exits_file = config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md')
+    artifacts_dir = config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts')
 
-    gen_coverage(df, network_coimbroes, network_article)
+    manifest_file = config.get('nodes', 'MANIFEST', fallback='./nodes/manifest.json')
+    incremental = config.getboolean('params', 'INCREMENTAL', fallback=True) # false prepares every network and sensor again
+    manifest = load_manifest(manifest_file)
+
+    # the coverage depends on the sensor locations and the two networks they are mapped to
+    coverage_file = config.get('sensors', 'COVERAGE', fallback='./sumo/coverage.md')
+    inputs_hash = get_inputs_hash([config.get('sensors', 'LOCATIONS', fallback='./data/sensor_locations.xlsx'), network_article_file, network_coimbroes_file])
+    if not incremental or get_cached_outputs(manifest, 'coverage', 'coverage', inputs_hash, [coverage_file]) is None:
+        df = pd.read_excel(config.get('sensors', 'LOCATIONS', fallback='./data/sensor_locations.xlsx'))
+        gen_coverage(df, sumolib.net.readNet(network_coimbroes_file), sumolib.net.readNet(network_article_file))
+        set_cached_outputs(manifest, 'coverage', 'coverage', inputs_hash, {})
+    else:
+        print("The sensor coverage is unchanged.")
+    save_manifest(manifest_file, manifest, 'coverage', ['coverage'])
 
+    network_names = []
     with open(entries_exits_file, 'w') as eef:
         for var, value in list(config.items('nodes')):
             if var.startswith('node_'):
                 node_name, network_file = value.split(',')
-                node_network = sumolib.net.readNet(network_file)
-                gen_entry_exit_nodes(node_name, node_network.getNodes(), eef)
-    
+                network_names.append(node_name)
+                inputs_hash = get_inputs_hash([network_file], [node_name])
+                cached = get_cached_outputs(manifest, 'entries_exits', node_name, inputs_hash, [f'{artifacts_dir}/{get_node_filename(network_file)}_nodes.npz']) if incremental else None
+                if cached is None:
+                    node_eef = io.StringIO()
+                    node_network = sumolib.net.readNet(network_file)
+                    gen_entry_exit_nodes(node_name, network_file, node_network.getNodes(), node_eef, artifacts_dir)
+                    cached = {'block': node_eef.getvalue()}
+                    set_cached_outputs(manifest, 'entries_exits', node_name, inputs_hash, cached)
+                else:
+                    print(f"The entry and exit nodes of {node_name} are unchanged.")
+                eef.write(cached['block'])
+    save_manifest(manifest_file, manifest, 'entries_exits', network_names)
+
     prepare_view()
-    prepare_data()
\ No newline at end of file
+    data_dir = config.get('dir', 'DATA', fallback='./data')
+    data_file = config.get('sensors', 'DATA', fallback='./data/sensor_data')
+    workers = int(config.get('params', 'PREPARE_WORKERS', fallback='0')) # 0 uses all the cores, 1 processes the sensors sequentially
+    excel_file = config.get('sensors', 'EXCEL_EXPORT', fallback='') # an optional copy of the sensor data as a workbook
+    prepare_data(data_dir, data_file, workers, excel_file, manifest_file if incremental else None)
\ No newline at end of file
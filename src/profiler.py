@@ -0,0 +1,167 @@
+"""Hot-Path Profiler
+
+This module measures where the time of a digital twin run goes, according to the `[profiler]` section of the `config.ini` file.
+It keeps the cumulative wall time and number of calls of each phase of the main loop, a histogram of the latency of the control computation of each minute and the number of calls of each TraCI function, writing a summary at the end of each hour and of the run.
+The phases of a disabled profiler are a shared context manager that does nothing, so that the main loop keeps its speed.
+
+"""
+
+import time
+import cProfile
+from collections import Counter
+from pathlib import Path
+import numpy as np
+
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000] # upper bounds (ms) of the histogram of the control latency, followed by an unbounded bucket
+TOP_TRACI_CALLS = 10 # TraCI functions listed in the summaries
+
+class Phase:
+    # accumulates the wall time and calls of a phase, keeping the duration of each call when `durations` is given
+    __slots__ = ('time', 'calls', 'start', 'durations')
+
+    def __init__(self, durations=None):
+        self.time, self.calls, self.start, self.durations = 0.0, 0, 0.0, durations
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.time += elapsed
+        self.calls += 1
+        if self.durations is not None:
+            self.durations.append(elapsed)
+        return False
+
+class NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PHASE = NoPhase()
+
+class CountingProxy:
+    # counts the calls to the functions of the TraCI library (e.g. `vehicle.getSpeed`) before forwarding them, the domains being wrapped in turn
+    def __init__(self, target, counts, domain=''):
+        self._target, self._counts, self._domain = target, counts, domain
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if callable(value) and not isinstance(value, type):
+            value = count_calls(value, f'{self._domain}{attr}', self._counts)
+        elif not self._domain and hasattr(value, 'getIDList'): # the domains of traci are objects and those of libsumo classes
+            value = CountingProxy(value, self._counts, f'{attr}.')
+        else:
+            return value
+        setattr(self, attr, value) # the next lookups skip `__getattr__`
+
+        return value
+
+def count_calls(function, name, counts):
+    def counted(*args, **kwargs):
+        counts[name] += 1
+        return function(*args, **kwargs)
+
+    return counted
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+
+    def start(self, config, profile_file, backend=None):
+        # `profile_file` is the path of the outputs without extension: the summaries (.txt), the cProfile statistics (.prof) and the phases as folded stacks (.folded)
+        self.enabled = config.getboolean('profiler', 'ENABLED', fallback=False)
+        if not self.enabled:
+            return
+
+        self.profile_file = profile_file
+        self.phases = {} # phase_name : Phase
+        self.latencies = [] # seconds of the control computation of each minute
+        self.traci_calls = Counter() # 'domain.function' : calls
+        self.last = self.snapshot()
+        self.start_time = self.last_time = time.perf_counter()
+        self.backend = backend
+        if backend is not None: # after `Backend.use`, which replaces the library
+            backend.module = CountingProxy(backend.module, self.traci_calls)
+        self.cprofile = cProfile.Profile() if config.getboolean('profiler', 'CPROFILE', fallback=False) else None # the statistics can be read with `pstats` or `snakeviz`
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+        Path(profile_file).parent.mkdir(parents=True, exist_ok=True)
+        open(f'{profile_file}.txt', 'w').close()
+
+    def phase(self, name):
+        # phases inside others are named after them, e.g. 'control.sampling' inside 'control'
+        if not self.enabled:
+            return NO_PHASE
+
+        if name not in self.phases:
+            self.phases[name] = Phase(self.latencies if name == 'control' else None)
+
+        return self.phases[name]
+
+    def snapshot(self):
+        return {name: (phase.time, phase.calls) for name, phase in self.phases.items()}, len(self.latencies), Counter(self.traci_calls)
+
+    def summary(self, title, since=None):
+        # the values since the `since` snapshot, or of the whole run
+        phases, latencies_start, traci_calls = since or ({}, 0, Counter())
+        wall = time.perf_counter() - (self.last_time if since else self.start_time)
+        lines = [f'::: Profile of {title} ({wall:.1f}s) :::', f"{'phase':<24}{'time (s)':>10}{'share':>8}{'calls':>10}{'mean (ms)':>11}"]
+        for name in sorted(self.phases.keys()):
+            total, calls = self.phases[name].time - phases.get(name, (0, 0))[0], self.phases[name].calls - phases.get(name, (0, 0))[1]
+            lines.append(f"{name:<24}{total:>10.2f}{total / wall:>8.1%}{calls:>10}{1000 * total / max(calls, 1):>11.3f}")
+
+        latencies = 1000 * np.array(self.latencies[latencies_start:])
+        if len(latencies):
+            lines.append(f'control latency (ms): mean {latencies.mean():.2f}, p50 {np.percentile(latencies, 50):.2f}, p95 {np.percentile(latencies, 95):.2f}, max {latencies.max():.2f}')
+            counts = np.bincount(np.searchsorted(LATENCY_BUCKETS, latencies), minlength=len(LATENCY_BUCKETS) + 1)
+            lines.append('  ' + ' | '.join(f'<={bound}: {count}' for bound, count in zip(LATENCY_BUCKETS, counts)) + f' | >{LATENCY_BUCKETS[-1]}: {counts[-1]}')
+
+        calls = self.traci_calls - traci_calls
+        lines.append(f'TraCI calls: {sum(calls.values())}')
+        lines.extend(f'  {name:<38}{count:>10}' for name, count in calls.most_common(TOP_TRACI_CALLS))
+
+        return '\n'.join(lines)
+
+    def write_summary(self, title, since=None, prefix=''):
+        summary = self.summary(title, since)
+        print('\n'.join(prefix + line for line in summary.split('\n')))
+        with open(f'{self.profile_file}.txt', 'a') as f:
+            f.write(summary + '\n\n')
+
+    def end_hour(self, hour, prefix=''):
+        if not self.enabled:
+            return
+
+        self.write_summary(f'hour {hour}', self.last, prefix)
+        self.last, self.last_time = self.snapshot(), time.perf_counter()
+
+    def stop(self, prefix=''):
+        if not self.enabled:
+            return
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(f'{self.profile_file}.prof')
+        self.write_summary('the run', prefix=prefix)
+        write_folded_stacks(f'{self.profile_file}.folded', self.phases, time.perf_counter() - self.start_time)
+        if self.backend is not None:
+            self.backend.module = self.backend.module._target
+        self.enabled = False
+
+def write_folded_stacks(folded_file, phases, wall):
+    # the self time of each phase in microseconds, one 'run;phase;subphase value' line each, the format of the flame graph tools (flamegraph.pl, speedscope, py-spy's raw output)
+    self_times = {'run': wall - sum(phase.time for name, phase in phases.items() if '.' not in name)}
+    for name, phase in phases.items():
+        children = sum(child.time for child_name, child in phases.items() if child_name.rsplit('.', 1)[0] == name and child_name != name)
+        self_times[f"run.{name}"] = phase.time - children
+
+    with open(folded_file, 'w') as f:
+        for name, self_time in self_times.items():
+            f.write(f"{name.replace('.', ';')} {max(round(self_time * 1e6), 0)}\n")
+
+profiler = Profiler()
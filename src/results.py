@@ -1,7 +1,7 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from .utils import load_config
+from .utils import load_config, read_results
 from matplotlib.dates import DateFormatter, HourLocator
 
 config = load_config()
@@ -9,14 +9,14 @@ results_dir = config.get('dir', 'RESULTS', fallback='./sumo/results')
 
 data = pd.DataFrame()
 dfs_data = {} # edge_id : data
+results = read_results(results_dir) # save_data_time : dataframe, whatever the `OUTPUT_FORMAT` of the run
 
 for hour in range(24):
     formatted_hour = f"{hour:02}"
-    excel_file = f'{results_dir}/flow_2022-03-24-{formatted_hour}-00.xlsx'
-    # excel_file = f'{results_dir}/flow_2023-05-24-{formatted_hour}-00.xlsx'
-    # excel_file = f'{results_dir}/flow_2023-05-25-{formatted_hour}-00.xlsx'
-    # excel_file = f'{results_dir}/flow_2023-05-26-{formatted_hour}-00.xlsx'
-    df = pd.read_excel(excel_file)
+    df = results[f'2022-03-24-{formatted_hour}-00']
+    # df = results[f'2023-05-24-{formatted_hour}-00']
+    # df = results[f'2023-05-25-{formatted_hour}-00']
+    # df = results[f'2023-05-26-{formatted_hour}-00']
 
     for column_name in df.columns:
         if column_name.startswith('TTS'):
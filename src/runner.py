@@ -0,0 +1,63 @@
+"""Multi-Network Runner
+
+This script runs the digital twin of several networks at the same time, one SUMO instance per network, in a pool of processes limited by the number of cores.
+The networks to simulate are read from the `[runner]` section of the `config.ini` file, and the results of each network are written to its own folder.
+
+"""
+
+import os, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .utils import load_config, get_node_filename
+from .backend import traci
+from .digital_twin import run_network
+
+def get_runner_networks(config):
+    selected = config.get('runner', 'NETWORKS', fallback='all') # 'all' or the names of the networks separated by ';'
+    networks = [tuple(value.split(',')) for var, value in config.items('nodes') if var.startswith('node_')] # [(network_name, network_file)]
+    if selected.strip() == 'all':
+        return networks
+
+    names = [name.strip() for name in selected.split(';')]
+    unknown = set(names) - {network_name for network_name, _ in networks}
+    if unknown:
+        sys.exit(f"Unknown networks in the [runner] section: {sorted(unknown)}")
+
+    return [network for network in networks if network[0] in names]
+
+def simulate_network(network_name, network_file, run_dir):
+    config = load_config()
+    try:
+        return run_network(config, network_name, network_file, label=get_node_filename(network_file), run_dir=run_dir)
+    finally:
+        if traci.isLoaded(): # free the SUMO instance of a failed run before the process is reused
+            traci.close()
+
+if __name__ == '__main__':
+    config = load_config()
+    networks = get_runner_networks(config)
+    runs_dir = config.get('runner', 'DIR', fallback='./sumo/runs')
+    workers = min(int(config.get('runner', 'WORKERS', fallback='0')) or os.cpu_count(), len(networks)) # 0 uses all the cores
+
+    print(f"Simulating {len(networks)} networks with {workers} worker(s)")
+    start_time = time.time()
+    summary = {} # network_name : (status, details)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(simulate_network, network_name, network_file, f'{runs_dir}/{get_node_filename(network_file)}'): network_name for network_name, network_file in networks}
+        for future in as_completed(futures):
+            network_name = futures[future]
+            try:
+                result = future.result()
+                summary[network_name] = ('OK', f"{result['hours']} hour(s) in {result['elapsed']:.0f}s, {len(result['result_files'])} result file(s)")
+            except Exception as e:
+                summary[network_name] = ('FAILED', f'{type(e).__name__}: {e}')
+            print(f"({len(summary)}/{len(networks)}) {network_name}: {summary[network_name][0]}")
+
+    print(f"\n::: Summary ({time.time() - start_time:.0f}s) :::\n")
+    for network_name, _ in networks: # in the order of the `config.ini` file
+        status, details = summary[network_name]
+        print(f"{network_name}: {status} - {details}")
+
+    failures = sum(status != 'OK' for status, _ in summary.values())
+    if failures:
+        sys.exit(f"\n{failures} of {len(networks)} networks failed")
@@ -1,12 +1,22 @@
 """Equation System Solver
 
 This script reads the equations of the VCI nodes from the file `equations.md` in the `docs` folder, presenting the free variables of each equation system.
+Besides the human-readable `free_variables.md` file, the matrices of each system are stored as a binary artifact in the `nodes/artifacts` folder, which is what the digital twin loads.
+The equation systems are independent, so they are solved in parallel by a pool of `SOLVER_WORKERS` processes, and written in the order of the `equations.md` file.
+Since the systems only have 0/±1 coefficients on the edge variables, the reduced row echelon form is computed by a sparse fraction-free elimination that carries the constant side as a linear form of the sensor variables.
 
 """
 
+import os
+import time
+from math import gcd
+from functools import partial
 import sympy
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-from .utils import load_config, remove_chars, get_variables
+from .utils import load_config, remove_chars, get_variables, save_artifact, get_node_filename, get_inputs_hash, load_manifest, save_manifest, get_cached_outputs, set_cached_outputs
+from .logic_functions import compile_list_expr, compile_x_particular
 
 def get_inequality_constraint_matrix(matrix, free_variables):
     ic_matrix = []
@@ -18,91 +28,223 @@ def get_inequality_constraint_matrix(matrix, free_variables):
         
     return ic_matrix
 
+def save_system_artifact(artifacts_dir, node_name, network_file, free_variables, A_ub, b_ub, Xparticular, Xnull, variables):
+    b_ub_symbols, b_ub_coefficients = compile_list_expr(b_ub)
+    Xparticular_symbols, Xparticular_coefficients = compile_x_particular(Xparticular)
+
+    save_artifact(artifacts_dir, node_name, network_file, 'system',
+                  free_vars=np.array(list(free_variables.keys()), dtype=np.str_),
+                  A_ub=np.array(A_ub, dtype=np.int64).reshape(len(A_ub), len(free_variables)),
+                  b_ub=np.array(b_ub, dtype=np.str_),
+                  Xparticular=np.array([row[0] for row in Xparticular], dtype=np.str_),
+                  Xnull=np.array(Xnull, dtype=np.int64).reshape(len(Xnull), len(free_variables)),
+                  eq_vars=np.array(variables, dtype=np.str_),
+                  b_ub_symbols=np.array(b_ub_symbols, dtype=np.str_),
+                  b_ub_coefficients=b_ub_coefficients,
+                  Xparticular_symbols=np.array(Xparticular_symbols, dtype=np.str_),
+                  Xparticular_coefficients=Xparticular_coefficients)
+
+def get_equation_systems(equations_file):
+    systems = [] # [(node_name, num_equations, [equations])]
+    with open(equations_file, 'r') as f:
+        lines = f.readlines()
+
+        for i, line in enumerate(lines):
+            if line.startswith('###'):
+                current_node = remove_chars(line.strip(), '#:')
+                node_name = current_node.split(' - ')[0].split(' of ')[1].strip()
+                num_equations = int(current_node.split(' - ')[1])
+                equations = [remove_chars(eq.strip(), '$_{}\\') for eq in lines[i+1:i+num_equations+1]]
+                systems.append((node_name, num_equations, equations))
+
+    return systems
+
+def combine_rows(a, row, b, pivot_row):
+    # a * row - b * pivot_row, dropping the entries that cancel out
+    combined = {key: a * value for key, value in row.items()}
+    for key, value in pivot_row.items():
+        combined[key] = combined.get(key, 0) - b * value
+        if combined[key] == 0:
+            del combined[key]
+
+    return combined
+
+def sparse_rref(coefficients, constants, num_variables):
+    # fraction-free Gauss-Jordan elimination over the sparse rows {column : coefficient}, applying the same row operations to the linear forms {q variable : coefficient} of the constant side
+    rows = [(dict(row), dict(constant)) for row, constant in zip(coefficients, constants)]
+    pivots = []
+    for col in range(num_variables):
+        candidates = [i for i in range(len(pivots), len(rows)) if col in rows[i][0]]
+        if not candidates:
+            continue
+
+        r = len(pivots)
+        pivot = min(candidates, key=lambda i: (abs(rows[i][0][col]), len(rows[i][0]))) # unit and short rows keep the numbers small and the rows sparse
+        rows[r], rows[pivot] = rows[pivot], rows[r]
+        a = rows[r][0][col]
+        for i, (row, constant) in enumerate(rows):
+            if i != r and col in row:
+                b = row[col]
+                row, constant = combine_rows(a, row, b, rows[r][0]), combine_rows(a, constant, b, rows[r][1])
+                divisor = gcd(*row.values(), *constant.values())
+                if divisor > 1:
+                    row, constant = {key: value // divisor for key, value in row.items()}, {key: value // divisor for key, value in constant.items()}
+                rows[i] = (row, constant)
+        pivots.append(col)
+
+    # normalize the pivots to 1 and build the dense matrix returned by `sympy.Matrix.rref`
+    matrix = []
+    for r, (row, constant) in enumerate(rows):
+        a = row[pivots[r]] if r < len(pivots) else 1
+        dense_row = [0] * num_variables
+        for col, value in row.items():
+            dense_row[col] = value // a if value % a == 0 else sympy.Rational(value, a)
+        dense_row.append(sympy.Add(*[sympy.Rational(value, a) * (sympy.Symbol(symbol) if symbol else 1) for symbol, value in constant.items()]))
+        matrix.append(dense_row)
+
+    return matrix, tuple(pivots)
+
+def get_linear_form(expr):
+    linear_form = {} # q variable : coefficient, with '' for the constant term
+    for term, coefficient in expr.as_coefficients_dict().items():
+        if not coefficient.is_Integer or not (term.is_Symbol or term == 1):
+            raise Exception(f"The constant side '{expr}' is not an integer linear form of the sensor variables, use RREF=sympy")
+        linear_form['' if term == 1 else str(term)] = int(coefficient)
+
+    return linear_form
+
+def solve_network(node_name, num_equations, equations, rref='sparse'):
+    start_time = time.perf_counter()
+    variables = get_variables(equations)
+    num_variables = len(variables)
+    positions = {var: pos for pos, var in enumerate(variables)}
+
+    matrix, coefficients, constants = [], [], []
+    for eq in equations:
+        row = {} # column : coefficient
+        vars = remove_chars(eq, '=').split()
+        for k, var in enumerate(vars):
+            if var.startswith('x'):
+                row[positions[var]] = -1 if vars[k-1] == '-' else 1
+            elif var.startswith('-x'):
+                row[positions[var[1:]]] = -1
+        
+        # append the constant side of the equation
+        constants_side = eq.split('=')[1].strip()
+        expr = sympy.parse_expr(constants_side)
+
+        if rref == 'sparse':
+            coefficients.append(row)
+            constants.append(get_linear_form(expr))
+        else:
+            dense_row = [0] * num_variables
+            for pos, value in row.items():
+                dense_row[pos] = value
+            dense_row.append(expr)
+            matrix.append(dense_row)
+
+    # find the reduced row echelon form of the matrix
+    if rref == 'sparse':
+        rref_rows, pivots = sparse_rref(coefficients, constants, num_variables)
+    else:
+        rref_matrix, pivots = sympy.Matrix(matrix).rref()
+        rref_rows = rref_matrix.tolist()
+
+    # find the free variables of the matrix
+    free_variables = {} # variable : index
+    for i in range(num_variables):
+        if i not in pivots:
+            free_variables[variables[i]] = i
+
+    A_ub = get_inequality_constraint_matrix(rref_rows, free_variables)
+    b_ub = [str(row[-1]) for row in rref_rows]
+
+    # build the Xparticular vector
+    Xparticular = []
+    b_ub_index = 0
+    for i in range(num_variables):
+        if i not in pivots:
+            Xparticular.append(['0'])
+        else:
+            Xparticular.append([b_ub[b_ub_index]])
+            b_ub_index += 1
+
+    # build the Xnull matrix
+    Xnull = []
+    A_ub_index = free_var_index = 0
+    for i in range(num_variables):
+        if i not in pivots:
+            new_row = [0] * len(free_variables)
+            new_row[free_var_index] = 1
+            Xnull.append(new_row)
+            free_var_index += 1
+        else:
+            new_row = [-x for x in A_ub[A_ub_index]]
+            Xnull.append(new_row)
+            A_ub_index += 1
+
+    num_free_variables = num_variables - num_equations
+    if len(free_variables) != num_free_variables:
+        raise Exception(f"Number of free variables ({len(free_variables)}) is not equal to 'num_variables - num_equations' ({num_free_variables}) in node {node_name}")
+    
+    variables = sorted(list(variables), key=lambda x: int(x[1:]))
+
+    # the SymPy integers are converted so that the results can be sent back from the worker processes
+    A_ub = [[int(x) for x in row] for row in A_ub]
+    Xnull = [[int(x) for x in row] for row in Xnull]
+
+    return free_variables, A_ub, b_ub, Xparticular, Xnull, variables, time.perf_counter() - start_time
+
 if __name__ == '__main__':
     config = load_config()
     equations_file = config.get('nodes', 'EQUATIONS', fallback='./nodes/equations.md')
     free_variables_file = config.get('nodes', 'FREE_VARIABLES', fallback='./nodes/free_variables.md')
-
-    with open(equations_file, 'r') as f:
-        lines = f.readlines()
-
-        with open(free_variables_file, 'w') as fv:
-            for i, line in enumerate(lines):
-                if line.startswith('###'):
-                    current_node = remove_chars(line.strip(), '#:')
-                    node_name = current_node.split(' - ')[0].split(' of ')[1].strip()
-                    num_equations = int(current_node.split(' - ')[1])
-                    equations = [remove_chars(eq.strip(), '$_{}\\') for eq in lines[i+1:i+num_equations+1]]
-
-                    variables = get_variables(equations)
-                    num_variables = len(variables)
-
-                    matrix = []
-                    for eq in equations:
-                        row = [0] * num_variables
-                        vars = remove_chars(eq, '=').split()
-                        for k, var in enumerate(vars):
-                            if var.startswith('x'):
-                                pos = variables.index(var)
-                                row[pos] = -1 if vars[k-1] == '-' else 1
-                            elif var.startswith('-x'):
-                                pos = variables.index(var[1:])
-                                row[pos] = -1
-                        
-                        # append the constant side of the equation
-                        constants = eq.split('=')[1].strip()
-                        expr = sympy.parse_expr(constants)
-                        row.append(expr)
-
-                        matrix.append(row)
-
-                    # find the reduced row echelon form of the matrix
-                    matrix = sympy.Matrix(matrix).rref()
-
-                    # find the free variables of the matrix
-                    free_variables = {} # variable : index
-                    for i in range(num_variables):
-                        if i not in matrix[1]:
-                            free_variables[variables[i]] = i
-
-                    A_ub = get_inequality_constraint_matrix(matrix[0].tolist(), free_variables)
-                    b_ub = [str(row[-1]) for row in matrix[0].tolist()]
-
-                    # build the Xparticular vector
-                    Xparticular = []
-                    b_ub_index = 0
-                    for i in range(num_variables):
-                        if i not in matrix[1]:
-                            Xparticular.append(['0'])
-                        else:
-                            Xparticular.append([b_ub[b_ub_index]])
-                            b_ub_index += 1
-
-                    # build the Xnull matrix
-                    Xnull = []
-                    A_ub_index = free_var_index = 0
-                    for i in range(num_variables):
-                        if i not in matrix[1]:
-                            new_row = [0] * len(free_variables)
-                            new_row[free_var_index] = 1
-                            Xnull.append(new_row)
-                            free_var_index += 1
-                        else:
-                            new_row = [-x for x in A_ub[A_ub_index]]
-                            Xnull.append(new_row)
-                            A_ub_index += 1
-
-                    num_free_variables = num_variables - num_equations
-                    if len(free_variables) != num_free_variables:
-                        raise Exception(f"Number of free variables ({len(free_variables)}) is not equal to 'num_variables - num_equations' ({num_free_variables})")
-                    
-                    variables = sorted(list(variables), key=lambda x: int(x[1:]))
-
-                    fv.write(f'### Free variables of {node_name}: {list(free_variables.keys())}\n')
-                    fv.write(f'Inequality constraint matrix of {node_name}: {A_ub}\n')
-                    fv.write(f'Inequality constraint vector of {node_name}: {b_ub}\n')
-                    fv.write(f'Xparticular vector of {node_name}: {Xparticular}\n')
-                    fv.write(f'Xnull matrix of {node_name}: {Xnull}\n')
-                    fv.write(f'Equation variables of {node_name}: {variables}\n')
-                    if i != len(lines) - 1: fv.write('\n')
-                    print(f"The free variables of the equation system of node {node_name} are: {list(free_variables.keys())}")
\ No newline at end of file
+    artifacts_dir = config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts')
+    network_files = dict(value.split(',') for var, value in config.items('nodes') if var.startswith('node_')) # network_name : network_file
+    workers = int(config.get('params', 'SOLVER_WORKERS', fallback='0')) or os.cpu_count() # 0 uses all the cores, 1 solves the networks sequentially
+    rref = config.get('params', 'RREF', fallback='sparse') # 'sympy' runs the dense symbolic elimination
+
+    manifest_file = config.get('nodes', 'MANIFEST', fallback='./nodes/manifest.json')
+    incremental = config.getboolean('params', 'INCREMENTAL', fallback=True) # false solves every equation system again
+
+    systems = get_equation_systems(equations_file)
+    manifest = load_manifest(manifest_file)
+    blocks, inputs_hashes, pending = {}, {}, [] # node_name : `free_variables.md` block of the systems whose equations did not change
+    for system in systems:
+        node_name, _, equations = system
+        inputs_hashes[node_name] = get_inputs_hash(values=[equations, rref])
+        output_files = [f'{artifacts_dir}/{get_node_filename(network_files[node_name])}_system.npz'] if node_name in network_files else []
+        cached = get_cached_outputs(manifest, 'solver', node_name, inputs_hashes[node_name], output_files) if incremental else None
+        if cached is not None:
+            blocks[node_name] = cached['block']
+        else:
+            pending.append(system)
+
+    start_time = time.perf_counter()
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            solutions = list(executor.map(partial(solve_network, rref=rref), *zip(*pending))) # `map` keeps the order of the `equations.md` file
+    else:
+        solutions = [solve_network(*system, rref=rref) for system in pending]
+    elapsed = time.perf_counter() - start_time
+
+    for (node_name, _, _), (free_variables, A_ub, b_ub, Xparticular, Xnull, variables, _) in zip(pending, solutions):
+        blocks[node_name] = (f'### Free variables of {node_name}: {list(free_variables.keys())}\n'
+                             f'Inequality constraint matrix of {node_name}: {A_ub}\n'
+                             f'Inequality constraint vector of {node_name}: {b_ub}\n'
+                             f'Xparticular vector of {node_name}: {Xparticular}\n'
+                             f'Xnull matrix of {node_name}: {Xnull}\n'
+                             f'Equation variables of {node_name}: {variables}\n\n')
+        if node_name in network_files:
+            save_system_artifact(artifacts_dir, node_name, network_files[node_name], free_variables, A_ub, b_ub, Xparticular, Xnull, variables)
+        set_cached_outputs(manifest, 'solver', node_name, inputs_hashes[node_name], {'block': blocks[node_name]})
+        print(f"The free variables of the equation system of node {node_name} are: {list(free_variables.keys())}")
+    save_manifest(manifest_file, manifest, 'solver', inputs_hashes)
+
+    with open(free_variables_file, 'w') as fv:
+        for node_name, _, _ in systems:
+            fv.write(blocks[node_name])
+
+    print(f"\nSolved {len(pending)} equation systems in {elapsed:.2f}s with {max(min(workers, len(pending)), 1)} worker(s), reused {len(systems) - len(pending)} unchanged:")
+    for (node_name, num_equations, _), (free_variables, *_, solve_time) in sorted(zip(pending, solutions), key=lambda solution: solution[1][-1], reverse=True):
+        print(f"{node_name}: {solve_time:.2f}s ({num_equations} equations, {len(free_variables)} free variables)")
@@ -1,8 +1,18 @@
+import os
 import re
-from itertools import product
+import json
+import hashlib
+import importlib.util
+import numpy as np
+import pandas as pd
+from pathlib import Path
 import xml.etree.cElementTree as ET
 from configparser import ConfigParser, ExtendedInterpolation
 
+ARTIFACTS_VERSION = 1 # bump when the arrays stored in the artifacts change, so that stale artifacts fall back to the markdown files
+MANIFEST_VERSION = 1 # bump when a phase writes different outputs for the same inputs, so that the next run rebuilds everything
+RESULTS_FORMATS = {'excel': '.xlsx', 'csv': '.csv.gz', 'parquet': '.parquet'} # output format : extension of the hourly results files
+
 def load_config():
     config = ConfigParser(interpolation=ExtendedInterpolation())
     config.read('config.ini')
@@ -112,14 +122,189 @@ def get_calibrators(additionals_file):
 
     return calibrators
 
-def get_probability_distributions(num_routes):
-    elements = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
-    combinations = []
+def get_compositions(total, parts):
+    # lazily yields the ways of writing `total` as `parts` non-negative integers, in descending lexicographic order
+    if parts == 1:
+        yield (total,)
+    elif parts > 1:
+        for first in range(total, -1, -1):
+            for rest in get_compositions(total - first, parts - 1):
+                yield (first,) + rest
+
+def get_split_percentages(shares):
+    # percentages in steps of 10 of the branches of a split, adding up to 100
+    if len(shares) == 2: # the first branch is rounded and the second takes the rest, as when only two-way splits were supported
+        first = int(np.clip(np.round(10 * shares[0]), 0, 10)) * 10
+        return (first, 100 - first)
+
+    shares = np.clip(np.asarray(shares, dtype=np.float64), 0, None)
+    tenths = 10 * shares / shares.sum() if shares.sum() > 0 else np.full(len(shares), 10 / len(shares))
+    rounded = np.floor(tenths).astype(int)
+    for i in np.argsort(rounded - tenths, kind='stable')[:10 - rounded.sum()]: # the largest remainders take the tenths left
+        rounded[i] += 1
+
+    return tuple(int(tenth) * 10 for tenth in rounded)
+
+def get_route_distribution_id(router_edge, percentages):
+    return f'routedist_{router_edge}' + ''.join(f'_{percentage}' for percentage in percentages)
+
+def get_node_filename(network_file):
+    return network_file.split('.')[-3].split('/')[-1]
+
+def get_artifacts_index(artifacts_dir):
+    index_file = Path(artifacts_dir) / 'index.json'
+    if index_file.exists():
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == ARTIFACTS_VERSION:
+            return index
+
+    return {'version': ARTIFACTS_VERSION, 'networks': {}} # network_name : {kind : filename}
+
+def save_artifact(artifacts_dir, network_name, network_file, kind, **arrays):
+    Path(artifacts_dir).mkdir(parents=True, exist_ok=True)
+    filename = f'{get_node_filename(network_file)}_{kind}.npz'
+    np.savez(Path(artifacts_dir) / filename, **arrays)
+
+    index = get_artifacts_index(artifacts_dir)
+    index['networks'].setdefault(network_name, {})[kind] = filename
+    with open(Path(artifacts_dir) / 'index.json', 'w') as f:
+        json.dump(index, f, indent=4, ensure_ascii=False)
+
+def load_artifact(artifacts_dir, network_name, kind):
+    if artifacts_dir is None:
+        return None
+
+    filename = get_artifacts_index(artifacts_dir)['networks'].get(network_name, {}).get(kind)
+    if filename is None or not (Path(artifacts_dir) / filename).exists():
+        return None
+
+    return np.load(Path(artifacts_dir) / filename, allow_pickle=False) # the arrays are only read when accessed
+
+def load_free_variables(artifacts_dir, free_variables_file, network_name):
+    system = load_artifact(artifacts_dir, network_name, 'system')
+    if system is None:
+        return get_free_variables(free_variables_file)[network_name], None
+
+    with system:
+        free_variables = (system['free_vars'].tolist(), system['A_ub'].tolist(), system['b_ub'].tolist(), [[expr] for expr in system['Xparticular'].tolist()], system['Xnull'].tolist(), system['eq_vars'].tolist())
+        compiled_expr = ((system['b_ub_symbols'].tolist(), system['b_ub_coefficients']), (system['Xparticular_symbols'].tolist(), system['Xparticular_coefficients']))
+
+    return free_variables, compiled_expr
+
+def load_entry_exit_nodes(artifacts_dir, entries_exits_file, network_name):
+    nodes = load_artifact(artifacts_dir, network_name, 'nodes')
+    if nodes is None:
+        return get_entry_exit_nodes(entries_exits_file, network_name)
+
+    with nodes:
+        return nodes['entry_nodes'].tolist(), nodes['exit_nodes'].tolist()
+
+def check_results_format(output_format):
+    # checked before the simulation starts, so that a run does not fail when its first hour is written
+    if output_format not in RESULTS_FORMATS:
+        raise Exception(f"Unknown output format '{output_format}', choose from {list(RESULTS_FORMATS.keys())}")
+    if output_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise Exception("The parquet output format requires pyarrow (pip install pyarrow)")
+
+def get_results_file(results_dir, network_name, save_data_time, output_format):
+    if output_format == 'parquet': # a dataset partitioned by network and day, so that multi-day runs of several networks can be read as one
+        return f'{results_dir}/network={network_name}/day={save_data_time[:10]}/flow_{save_data_time}.parquet'
+    return f'{results_dir}/flow_{save_data_time}{RESULTS_FORMATS[output_format]}'
+
+def write_results(df, results_file):
+    Path(results_file).parent.mkdir(parents=True, exist_ok=True)
+    if results_file.endswith('.parquet'):
+        df.to_parquet(results_file, index=False)
+    elif results_file.endswith('.csv.gz'):
+        df.to_csv(results_file, index=False) # the compression is inferred from the extension
+    else:
+        df.to_excel(results_file, index=False)
+
+    return results_file
+
+def read_results(results_dir, network_name=None):
+    results = {} # save_data_time : dataframe, for the hourly results files of any format in the folder
+    for results_file in sorted(Path(results_dir).rglob('flow_*')):
+        if network_name and results_file.suffix == '.parquet' and f'network={network_name}' not in results_file.parts:
+            continue
+        save_data_time = results_file.name[len('flow_'):].split('.')[0]
+        if results_file.name.endswith('.parquet'):
+            results[save_data_time] = pd.read_parquet(results_file)
+        elif results_file.name.endswith('.csv.gz'):
+            results[save_data_time] = pd.read_csv(results_file)
+        elif results_file.name.endswith('.xlsx'):
+            results[save_data_time] = pd.read_excel(results_file)
+
+    return dict(sorted(results.items()))
+
+def get_file_hash(file):
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def save_sheet(sheets_dir, sheet_name, values):
+    tmp_file = Path(sheets_dir) / f'{sheet_name}.{os.getpid()}.tmp.npy'
+    np.save(tmp_file, values)
+    os.replace(tmp_file, Path(sheets_dir) / f'{sheet_name}.npy') # processes writing the same sheet at the same time never leave a partial file
+
+def load_sheets(sheets_dir, sheet_names):
+    return {sheet_name: np.load(Path(sheets_dir) / f'{sheet_name}.npy', mmap_mode='r') for sheet_name in sheet_names}
+
+def load_sheets_cache(cache_dir, data_file, sheet_names):
+    # the sheets of the workbook are converted once to .npy files, in a folder keyed by the hash of the workbook, and memory-mapped by the later runs
+    sheets_dir = Path(cache_dir) / f'{Path(data_file).stem}_{get_file_hash(data_file)[:16]}'
+    missing = [sheet_name for sheet_name in sheet_names if not (sheets_dir / f'{sheet_name}.npy').exists()]
+    if missing:
+        sheets_dir.mkdir(parents=True, exist_ok=True)
+        with pd.ExcelFile(data_file) as workbook:
+            for sheet_name in missing:
+                values = pd.read_excel(workbook, sheet_name=sheet_name).to_numpy()
+                save_sheet(sheets_dir, sheet_name, values.astype(np.str_ if values.dtype == object else np.float64))
+
+    return load_sheets(sheets_dir, sheet_names)
+
+def get_inputs_hash(files=(), values=()):
+    # hash of the contents of the input files and folders of a phase, and of the values (e.g. `config.ini` options) it depends on
+    sha = hashlib.sha256(str(MANIFEST_VERSION).encode())
+    for file in files:
+        path = Path(file)
+        if path.is_dir():
+            for member in sorted(path.rglob('*')):
+                if member.is_file():
+                    sha.update(member.relative_to(path).as_posix().encode())
+                    sha.update(get_file_hash(member).encode())
+        else:
+            sha.update(get_file_hash(path).encode() if path.exists() else b'missing')
+    sha.update(json.dumps(values, sort_keys=True, default=str).encode())
+
+    return sha.hexdigest()
+
+def load_manifest(manifest_file):
+    if Path(manifest_file).exists():
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+
+    return {'version': MANIFEST_VERSION, 'phases': {}} # phase : {key : {'inputs': hash, 'cached': outputs}}
+
+def save_manifest(manifest_file, manifest, phase, keys):
+    # only the networks and sensors of the current run are kept
+    manifest['phases'][phase] = {key: entry for key, entry in manifest['phases'].get(phase, {}).items() if key in keys}
+    Path(manifest_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
 
-    for combo in product(elements, repeat=num_routes):
-        if sum(combo) == 1:
-            combinations.append(combo)
+def get_cached_outputs(manifest, phase, key, inputs_hash, output_files=()):
+    entry = manifest['phases'].get(phase, {}).get(key)
+    if entry is None or entry['inputs'] != inputs_hash or not all(Path(file).exists() for file in output_files):
+        return None
 
-    combinations.sort(reverse=True)
+    return entry['cached']
 
-    return combinations
\ No newline at end of file
+def set_cached_outputs(manifest, phase, key, inputs_hash, cached):
+    manifest['phases'].setdefault(phase, {})[key] = {'inputs': inputs_hash, 'cached': cached}
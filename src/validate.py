@@ -0,0 +1,171 @@
+"""Implementation Cross-Checks
+
+This script verifies that the optimised structures and engines of the framework produce the same results as the reference implementations, for every network in the `config.ini` file.
+The checks to run can be given as arguments (e.g. `python -m src.validate topology`), otherwise all of them are executed.
+
+"""
+
+import sys
+import sumolib
+import numpy as np
+
+from .utils import load_config, get_free_variables, get_entry_exit_nodes, load_artifact, load_free_variables, load_entry_exit_nodes
+from .digital_twin import get_node_sensors, initialize_variables, get_sensors_edges, index_counting_edges, index_edge_nodes, reset_flow_speed_min, get_counting_edges, get_counting_edges_exits, get_node
+from .solver import get_equation_systems, solve_network
+import src.logic_functions as fn
+
+def get_networks(config):
+    networks = [] # [(network_name, network_file)]
+    for var, value in list(config.items('nodes')):
+        if var.startswith('node_'):
+            networks.append(tuple(value.split(',')))
+
+    return networks
+
+def validate_topology(config):
+    entries_exits_file = config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md')
+    failures = 0
+
+    print(f"\n::: Topology index against the graph searches :::\n")
+    for network_name, network_file in get_networks(config):
+        network = sumolib.net.readNet(network_file)
+        _, node_sensors = get_node_sensors(config, network_name)
+        entry_nodes, exit_nodes, _, _, sensors, _ = initialize_variables(network_name, network_file, node_sensors, entries_exits_file)
+        sensors_edges = get_sensors_edges(network, sensors)
+
+        mismatches = []
+        reference_error = index_error = None
+        try:
+            reference_counting_edges = {}
+            for node in entry_nodes:
+                start_edge, next_edge = get_counting_edges(network.getNode(node).getOutgoing()[0], sensors_edges)
+                reference_counting_edges[('in', node)] = (start_edge.getID(), next_edge.getID())
+            for node in exit_nodes:
+                start_edge, next_edge = get_counting_edges_exits(network.getNode(node).getIncoming()[0], sensors_edges)
+                reference_counting_edges[('out', node)] = (start_edge.getID(), next_edge.getID())
+        except Exception as e:
+            reference_error = str(e)
+        try:
+            entry_counting_edges, exit_counting_edges = index_counting_edges(network, entry_nodes, exit_nodes, sensors_edges)
+        except Exception as e:
+            index_error = str(e)
+
+        if reference_error or index_error: # networks that cannot be simulated must fail the same way
+            if reference_error != index_error:
+                mismatches.append(f"counting edges error '{index_error}' instead of '{reference_error}'")
+        else:
+            indexed_counting_edges = {('in', node): edges for node, edges in entry_counting_edges.items()} | {('out', node): edges for node, edges in exit_counting_edges.items()}
+            for key, edges in reference_counting_edges.items():
+                if indexed_counting_edges.get(key) != edges:
+                    mismatches.append(f"counting edges of {key[0]} node {key[1]}")
+
+        edge_nodes = index_edge_nodes(network, entry_nodes, exit_nodes)
+        flow_speed_min = reset_flow_speed_min(entry_nodes, exit_nodes)
+        for edge in network.getEdges():
+            if edge_nodes.get(edge.getID()) != get_node(network, flow_speed_min, edge.getID()):
+                mismatches.append(f"node of edge {edge.getID()}")
+
+        if mismatches:
+            print(f"{network_name}: {len(mismatches)} mismatches ({', '.join(mismatches)})")
+            failures += 1
+        elif reference_error:
+            print(f"{network_name}: OK ({len(edge_nodes)} indexed edges, counting edges fail as in the graph search: {reference_error})")
+        else:
+            print(f"{network_name}: OK ({len(reference_counting_edges)} counting pairs, {len(edge_nodes)} indexed edges)")
+
+    return failures
+
+def validate_expressions(config, samples=100):
+    free_variables = get_free_variables(config.get('nodes', 'FREE_VARIABLES', fallback='./nodes/free_variables.md'))
+    rng = np.random.default_rng(0)
+    failures = 0
+
+    print(f"\n::: Compiled expressions against the SymPy substitution :::\n")
+    for network_name, (_, _, b_ub, Xparticular_expr, _, _) in free_variables.items():
+        compiled_b_ub, compiled_Xparticular = fn.compile_list_expr(b_ub), fn.compile_x_particular(Xparticular_expr)
+        symbols = sorted(set(compiled_b_ub[0]) | set(compiled_Xparticular[0]), key=lambda x: int(x[1:]))
+
+        mismatches = 0
+        for i in range(samples):
+            values = rng.integers(0, 3000, len(symbols)) if i % 2 == 0 else rng.uniform(0, 3000, len(symbols)) # sensor flows are counts, but the aggregation may yield fractional values
+            variables_values = {symbol: [value, 0] for symbol, value in zip(symbols, values)}
+            if not np.array_equal(fn.calc_list_expr(compiled_b_ub, variables_values), fn.calc_list_expr(b_ub, variables_values)) or not np.array_equal(fn.calc_x_particular(compiled_Xparticular, variables_values), fn.calc_x_particular(Xparticular_expr, variables_values)):
+                mismatches += 1
+
+        if mismatches:
+            print(f"{network_name}: {mismatches} of {samples} sensor samples differ")
+            failures += 1
+        else:
+            print(f"{network_name}: OK ({len(b_ub)} constraints and {len(Xparticular_expr)} Xparticular entries over {len(symbols)} sensor variables)")
+
+    return failures
+
+def validate_artifacts(config):
+    free_variables_file = config.get('nodes', 'FREE_VARIABLES', fallback='./nodes/free_variables.md')
+    entries_exits_file = config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md')
+    artifacts_dir = config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts')
+    free_variables = get_free_variables(free_variables_file)
+    failures = 0
+
+    print(f"\n::: Binary artifacts against the markdown files :::\n")
+    for network_name, _ in get_networks(config):
+        missing = [kind for kind in ['nodes', 'system'] if load_artifact(artifacts_dir, network_name, kind) is None]
+        if missing:
+            print(f"{network_name}: missing {' and '.join(missing)} artifact (run `make prepare` and `make solve`)")
+            failures += 1
+            continue
+
+        mismatches = []
+        if load_entry_exit_nodes(artifacts_dir, entries_exits_file, network_name) != get_entry_exit_nodes(entries_exits_file, network_name):
+            mismatches.append('entry and exit nodes')
+
+        system, (compiled_b_ub, compiled_Xparticular) = load_free_variables(artifacts_dir, free_variables_file, network_name)
+        for name, loaded, parsed in zip(['free variables', 'A_ub', 'b_ub', 'Xparticular', 'Xnull', 'equation variables'], system, free_variables[network_name]):
+            if loaded != parsed:
+                mismatches.append(name)
+        for name, (symbols, coefficients), (parsed_symbols, parsed_coefficients) in [('compiled b_ub', compiled_b_ub, fn.compile_list_expr(free_variables[network_name][2])), ('compiled Xparticular', compiled_Xparticular, fn.compile_x_particular(free_variables[network_name][3]))]:
+            if symbols != parsed_symbols or not np.array_equal(coefficients, parsed_coefficients):
+                mismatches.append(name)
+
+        if mismatches:
+            print(f"{network_name}: {len(mismatches)} mismatches ({', '.join(mismatches)})")
+            failures += 1
+        else:
+            print(f"{network_name}: OK")
+
+    return failures
+
+def validate_rref(config):
+    failures = 0
+
+    print(f"\n::: Sparse elimination against the SymPy RREF :::\n")
+    for node_name, num_equations, equations in get_equation_systems(config.get('nodes', 'EQUATIONS', fallback='./nodes/equations.md')):
+        *sparse_solution, sparse_time = solve_network(node_name, num_equations, equations, rref='sparse')
+        *sympy_solution, sympy_time = solve_network(node_name, num_equations, equations, rref='sympy')
+
+        mismatches = [name for name, sparse, reference in zip(['free variables', 'A_ub', 'b_ub', 'Xparticular', 'Xnull', 'equation variables'], sparse_solution, sympy_solution) if sparse != reference]
+        if mismatches:
+            print(f"{node_name}: {len(mismatches)} mismatches ({', '.join(mismatches)})")
+            failures += 1
+        else:
+            print(f"{node_name}: OK ({sparse_time * 1000:.1f} ms against {sympy_time * 1000:.1f} ms)")
+
+    return failures
+
+VALIDATIONS = {
+    'topology': validate_topology,
+    'expressions': validate_expressions,
+    'artifacts': validate_artifacts,
+    'rref': validate_rref,
+}
+
+if __name__ == '__main__':
+    config = load_config()
+    failures = 0
+    for name in sys.argv[1:] or VALIDATIONS.keys():
+        if name not in VALIDATIONS:
+            sys.exit(f"Unknown validation '{name}', choose from {list(VALIDATIONS.keys())}")
+        failures += VALIDATIONS[name](config)
+
+    if failures:
+        sys.exit(f"\n{failures} validation(s) failed")
@@ -11,11 +11,12 @@ import sys
 import sympy
 import pickle
 import sumolib
+import io
 import collections
 import xml.etree.cElementTree as ET
 from shapely.geometry import LineString
 
-from .utils import load_config, remove_chars, write_xml, get_sensors_coverage, get_entry_exit_nodes
+from .utils import load_config, remove_chars, write_xml, get_sensors_coverage, load_entry_exit_nodes, get_node_filename, get_inputs_hash, load_manifest, save_manifest, get_cached_outputs, set_cached_outputs
 
 def get_variable_name(edge_id, network_name, sensors_coverage, network_sensors, variable_count):
     variable = f'x{variable_count}'
@@ -558,9 +559,9 @@ def reduce_equations(equations):
 
     return new_equations
 
-def process_network(network_name, network_file, nodes_dir, entries_exits_file, nsf, ef, sensors_coverage, network_sensors):
+def process_network(network_name, network_file, nodes_dir, entries_exits_file, artifacts_dir, nsf, ef, sensors_coverage, network_sensors):
     network = sumolib.net.readNet(network_file)
-    entry_nodes_ids, exit_nodes_ids = get_entry_exit_nodes(entries_exits_file, network_name)
+    entry_nodes_ids, exit_nodes_ids = load_entry_exit_nodes(artifacts_dir, entries_exits_file, network_name)
     entry_nodes, exit_nodes = [network.getNode(node_id) for node_id in entry_nodes_ids], [network.getNode(node_id) for node_id in exit_nodes_ids]
 
     variable_count, router_count, equations = gen_variables(network, network_name, nodes_dir, entry_nodes, exit_nodes, sensors_coverage, network_sensors, network_file)
@@ -594,14 +595,35 @@ if __name__ == '__main__':
     entries_exits_file = config.get('nodes', 'ENTRIES_EXITS', fallback='./nodes/entries_exits.md')
     equations_file = config.get('nodes', 'EQUATIONS', fallback='./nodes/equations.md')
     nodes_dir = config.get('dir', 'NODES', fallback='./nodes')
+    artifacts_dir = config.get('dir', 'ARTIFACTS', fallback='./nodes/artifacts')
+
+    manifest_file = config.get('nodes', 'MANIFEST', fallback='./nodes/manifest.json')
+    incremental = config.getboolean('params', 'INCREMENTAL', fallback=True) # false processes every network again
 
     network_sensors = {}
     sensors_coverage = get_sensors_coverage(coverage_file)
+    manifest = load_manifest(manifest_file)
+    processed = []
 
     with open(network_sensors_file, 'w') as nsf, open(equations_file, 'w') as ef:
         for var, value in list(config.items('nodes')):
             if var.startswith('node_'):
                 network_name, network_file = value.split(',')
-                network_sensors[network_name] = []
-                print(f"::: Processing network {network_name} :::\n")
-                process_network(network_name, network_file, nodes_dir, entries_exits_file, nsf, ef, sensors_coverage, network_sensors)
\ No newline at end of file
+                # the variables depend on the network, the sensors covering it and its own entry and exit nodes, from the nodes artifact or the entries and exits file
+                inputs_hash = get_inputs_hash([network_file, coverage_file], [network_name, load_entry_exit_nodes(artifacts_dir, entries_exits_file, network_name)])
+                output_files = [f'{nodes_dir}/variables_{get_node_filename(network_file)}.pkl', network_file.replace('.net', '_poi')]
+                cached = get_cached_outputs(manifest, 'variables', network_name, inputs_hash, output_files) if incremental else None
+                if cached is None:
+                    network_sensors[network_name] = []
+                    print(f"::: Processing network {network_name} :::\n")
+                    network_nsf, network_ef = io.StringIO(), io.StringIO()
+                    process_network(network_name, network_file, nodes_dir, entries_exits_file, artifacts_dir, network_nsf, network_ef, sensors_coverage, network_sensors)
+                    cached = {'sensors': network_nsf.getvalue(), 'equations': network_ef.getvalue()}
+                    set_cached_outputs(manifest, 'variables', network_name, inputs_hash, cached)
+                    processed.append(network_name)
+                nsf.write(cached['sensors'])
+                ef.write(cached['equations'])
+
+    network_names = [value.split(',')[0] for var, value in config.items('nodes') if var.startswith('node_')]
+    save_manifest(manifest_file, manifest, 'variables', network_names)
+    print(f"Processed {len(processed)} networks, reused {len(network_names) - len(processed)} unchanged.")
\ No newline at end of file